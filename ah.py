@@ -1,6 +1,5 @@
 import cv2
 import numpy as np
-from PIL import ImageGrab
 import pyautogui
 import pyperclip
 import threading
@@ -11,6 +10,14 @@ from mss import mss
 import sys
 import os
 import base64
+import json
+import collections
+import contextlib
+import functools
+import queue
+import zipfile
+import argparse
+import tracemalloc
 import ctypes
 from ctypes import wintypes
 from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout,
@@ -33,16 +40,88 @@ MANROPE_TTF_B64 = 'AAEAAAAPAIAAAwBwR1BPU3EucYgAAEZIAAA1YkdTVUKYP7EkAAAf0AAAD05PU
 # Hotbar size; also max items to shift-click from order/backpack in one batch/sequence.
 MAX_ITEMS_PER_ORDER_SEQUENCE = 9
 
-_USER32 = ctypes.windll.user32
-_KERNEL32 = ctypes.windll.kernel32
+# Union of hotbar, GUI template bbox and AH/order/backpack boxes: one grab per tick covers all detectors.
+CAPTURE_BBOX = (600, 146, 1320, 1020)
+CAPTURE_FPS = 30
+
+# Area searched for the AH book / backpack "hijau" / order GUI templates.
+GUI_TEMPLATE_BBOX = (600, 250, 1300, 760)
+GUI_TEMPLATE_THRESHOLD = 0.8
+# Screen-state priority when several templates match: ORDER over BACKPACK over AUCTION.
+GUI_STATE_PRIORITY = ('order', 'backpack', 'chest')
+
+# Reference layout all coordinates below were measured on: maximized 1920x1080 window,
+# GUI scale 4. Containers are centred on the client area ('center' anchor), the hotbar
+# sits on its bottom edge ('bottom' anchor).
+REFERENCE_GUI_SCALE = 4
+REFERENCE_CLIENT_SIZE = (1920, 1010)
+REFERENCE_ANCHORS = {'center': (960, 515), 'bottom': (960, 1020)}
+LAYOUT_BOXES = {
+    'hotbar': ((600, 933, 1320, 1020), 'bottom'),
+    'chest': ((635, 255, 1283, 473), 'center'),
+    'order': ((635, 146, 1283, 364), 'center'),
+    'backpack': ((635, 525, 1283, 743), 'center'),
+    'gui': (GUI_TEMPLATE_BBOX, 'center'),
+}
+LAYOUT_POINTS = {
+    'menu_button': ((1100, 540), 'center'),
+    'sell_confirm': ((1101, 364), 'center'),
+    'order_confirm': ((960, 360), 'center'),
+    'order_option_1': ((670, 300), 'center'),
+    'order_option_2': ((740, 300), 'center'),
+    'order_option_3': ((810, 300), 'center'),
+    'order_option_4': ((880, 300), 'center'),
+}
+
+# Replays and simulations turn this off so they neither read nor overwrite the live calibration caches.
+USER_CACHES = True
+
+# Actions every input backend implements (see InputBackend).
+INPUT_ACTIONS = ('press', 'hotkey', 'write', 'click', 'move_to', 'mouse_down', 'mouse_up', 'key_down', 'key_up',
+                 'scroll', 'copy')
+
+# Input pacing. No backend pauses on its own, so every wait the game needs is one of these:
+# chat opens on the next client tick, server-opened GUIs need a round trip, a confirm click
+# needs the server to close its GUI, container clicks need a frame to register. The
+# TimingCalibrator starts from these and learns the waits it can see end (TIMING_STEPS).
+CHAT_OPEN_DELAY = 0.1
+SERVER_GUI_DELAY = 0.4
+GUI_CLOSE_DELAY = 0.2
+SLOT_HOVER_DELAY = 0.02
+SLOT_CLICK_DELAY = 0.08
+# Starting wait for the hotbar to show a confirmed sale, and the grace allowed once the learned
+# wait runs out, before the selling loop falls back to a checkpoint.
+SELL_CONFIRM_TIMEOUT = 0.6
+# Longest wait for a shift-clicked slot to read empty before the next click goes out anyway.
+TRANSFER_CONFIRM_TIMEOUT = 0.25
+# Pointer step while shift-dragging across a row; each slot passed over needs a frame to register.
+DRAG_STEP_DELAY = 0.03
+# Ways to move items out of a container, cheapest first when several fit (see plan_transfer).
+TRANSFER_STRATEGIES = ('double', 'drag', 'click')
+# Waits the TimingCalibrator learns, each starting from its hand-tuned value: a click opening a
+# server GUI, a chat command's GUI (no template to watch), a container closing, a sale and a
+# shift-click showing on screen.
+TIMING_STEPS = {
+    'server_gui': SERVER_GUI_DELAY,
+    'command': SERVER_GUI_DELAY,
+    'gui_close': 0.3,
+    'sell_confirm': SELL_CONFIRM_TIMEOUT,
+    'transfer': TRANSFER_CONFIRM_TIMEOUT,
+}
+
+# Win32 helpers are inert elsewhere so detectors can run against replayed frames off Windows.
+if sys.platform == "win32":
+    _USER32 = ctypes.windll.user32
+    _KERNEL32 = ctypes.windll.kernel32
+    WNDENUMPROC = ctypes.WINFUNCTYPE(ctypes.c_bool, wintypes.HWND, wintypes.LPARAM)
+else:
+    _USER32 = _KERNEL32 = WNDENUMPROC = None
 _SW_MAXIMIZE = 3
 GWL_STYLE = -16
 WS_MAXIMIZE_BIT = 0x01000000
 PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
 MINECRAFT_PROCESSES = {"javaw.exe", "minecraft.exe", "minecraftlauncher.exe"}
 
-WNDENUMPROC = ctypes.WINFUNCTYPE(ctypes.c_bool, wintypes.HWND, wintypes.LPARAM)
-
 
 def get_process_name(hwnd):
     pid = ctypes.wintypes.DWORD()
@@ -63,12 +142,11 @@ def is_maximized(hwnd):
     return bool(_USER32.GetWindowLongW(hwnd, GWL_STYLE) & WS_MAXIMIZE_BIT)
 
 
-def maximize_minecraft_window():
-    """
-    Maximize the first visible top-level Minecraft window by process name.
-    Returns True if a window was found and maximized.
-    """
+def find_minecraft_windows():
+    """Visible top-level Minecraft windows as (hwnd, title, process name)."""
     found = []
+    if _USER32 is None:
+        return found
 
     def _enum_proc(hwnd, _lparam):
         if not _USER32.IsWindowVisible(hwnd):
@@ -83,6 +161,38 @@ def maximize_minecraft_window():
         return True
 
     _USER32.EnumWindows(WNDENUMPROC(_enum_proc), 0)
+    return found
+
+
+def minecraft_has_focus():
+    """True when a Minecraft window is in the foreground (always True off Windows)."""
+    if _USER32 is None:
+        return True
+    foreground = _USER32.GetForegroundWindow()
+    return any(hwnd == foreground for hwnd, _, _ in find_minecraft_windows())
+
+
+def get_minecraft_client_rect():
+    """Screen rect (x1, y1, x2, y2) of the first Minecraft window's client area, or None."""
+    found = find_minecraft_windows()
+    if not found:
+        return None
+    hwnd = found[0][0]
+    rect = wintypes.RECT()
+    if not _USER32.GetClientRect(hwnd, ctypes.byref(rect)):
+        return None
+    origin = wintypes.POINT(0, 0)
+    if not _USER32.ClientToScreen(hwnd, ctypes.byref(origin)):
+        return None
+    return origin.x, origin.y, origin.x + rect.right, origin.y + rect.bottom
+
+
+def maximize_minecraft_window():
+    """
+    Maximize the first visible top-level Minecraft window by process name.
+    Returns True if a window was found and maximized.
+    """
+    found = find_minecraft_windows()
     if not found:
         return False
 
@@ -114,6 +224,253 @@ def imdecode_from_base64(b64, flags=cv2.IMREAD_UNCHANGED):
     return cv2.imdecode(buf, flags)
 
 
+def user_data_path(filename):
+    """Writable per-user location for calibration caches (%APPDATA%\\Auto on Windows)."""
+    base = os.environ.get('APPDATA') or os.path.expanduser('~')
+    folder = os.path.join(base, 'Auto')
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, filename)
+
+
+def load_json_cache(filename):
+    if not USER_CACHES:
+        return {}
+    try:
+        with open(user_data_path(filename), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_json_cache(filename, data):
+    if not USER_CACHES:
+        return
+    try:
+        with open(user_data_path(filename), 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=1)
+    except OSError as e:
+        print(f"Could not save {filename}: {e}")
+
+
+class TraceLog:
+    """Trace-event recorder (the JSON chrome://tracing and Perfetto load), one track per thread.
+
+    Spans become complete ('X') events whose category is the part of the
+    name before the first dot: capture, hotbar, screen, slots, input, ui,
+    sleep; automation phases and helpers have no dot.
+    """
+
+    MAX_EVENTS = 500000
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.origin = time.perf_counter()
+        self._events = collections.deque(maxlen=self.MAX_EVENTS)
+        self._threads = {}
+
+    def _tid(self):
+        tid = threading.get_ident()
+        if tid not in self._threads:
+            thread = threading.current_thread()
+            self._threads[tid] = "Qt main" if thread is threading.main_thread() else thread.name
+        return tid
+
+    def complete(self, name, started, ended):
+        self._events.append({
+            'name': name, 'cat': name.split('.', 1)[0] if '.' in name or name == 'sleep' else 'automation',
+            'ph': 'X', 'pid': self.pid, 'tid': self._tid(),
+            'ts': round((started - self.origin) * 1e6, 1), 'dur': round((ended - started) * 1e6, 1),
+        })
+
+    def instant(self, name, **args):
+        """A point-in-time ('i') event on the calling thread's track, e.g. a decision and its inputs."""
+        self._events.append({
+            'name': name, 'cat': 'automation', 'ph': 'i', 's': 't', 'pid': self.pid, 'tid': self._tid(),
+            'ts': round((time.perf_counter() - self.origin) * 1e6, 1), 'args': args,
+        })
+
+    def save(self, path):
+        events = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid, 'args': {'name': name}}
+            for tid, name in list(self._threads.items())
+        ]
+        events += list(self._events)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+class StageTimer:
+    """Wall-time statistics per named stage: count, mean, p50, p95 and max.
+
+    span(name) times a block; stage(name) ends the calling thread's current
+    phase and starts the next one, for long procedures with early returns.
+    Disabled by default, in which case span() hands back a shared no-op
+    context and stage() returns at once. With a TraceLog attached every
+    span is also written to the trace.
+    """
+
+    # Percentiles come from the most recent samples of each stage.
+    MAX_SAMPLES = 4096
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.trace = None
+        self._samples = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._phase = threading.local()
+
+    def add(self, name, seconds):
+        with self._lock:
+            samples = self._samples.get(name)
+            if samples is None:
+                samples = self._samples[name] = collections.deque(maxlen=self.MAX_SAMPLES)
+            samples.append(seconds)
+            self._counts[name] = self._counts.get(name, 0) + 1
+
+    def record(self, name, started, ended):
+        """Add one span given its perf_counter() bounds."""
+        self.add(name, ended - started)
+        if self.trace is not None:
+            self.trace.complete(name, started, ended)
+
+    @contextlib.contextmanager
+    def _timed(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, started, time.perf_counter())
+
+    def span(self, name):
+        if not self.enabled:
+            return _NO_SPAN
+        return self._timed(name)
+
+    def stage(self, name):
+        """Close this thread's open phase (if any) and open name; None just closes."""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        current = getattr(self._phase, 'current', None)
+        if current is not None:
+            self.record(current[0], current[1], now)
+        self._phase.current = (name, now) if name is not None else None
+
+    def summary(self):
+        """{name: {'count', 'mean', 'p50', 'p95', 'max', 'total'}}, times in seconds."""
+        with self._lock:
+            stages = [(name, np.fromiter(samples, float), self._counts[name])
+                      for name, samples in self._samples.items()]
+        summary = {}
+        for name, values, count in stages:
+            p50, p95 = np.percentile(values, (50, 95))
+            summary[name] = {
+                'count': count,
+                'mean': float(values.mean()),
+                'p50': float(p50),
+                'p95': float(p95),
+                'max': float(values.max()),
+                'total': float(values.mean() * count),
+            }
+        return summary
+
+    def reset(self):
+        with self._lock:
+            self._samples = {}
+            self._counts = {}
+
+    def dump(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'written': time.strftime('%Y-%m-%d %H:%M:%S'), 'stages': self.summary()}, f, indent=1)
+
+
+_NO_SPAN = contextlib.nullcontext()
+STAGE_TIMER = StageTimer()
+
+
+def timed(name):
+    """Decorator: record each call under name while STAGE_TIMER is enabled."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not STAGE_TIMER.enabled:
+                return fn(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                STAGE_TIMER.record(name, started, time.perf_counter())
+        return wrapper
+    return decorate
+
+
+def serpentine_order(positions, start=None, row_tolerance=20):
+    """Order click targets row by row, alternating direction, for the shortest pointer path.
+
+    With a start point the walk begins at the nearest row and the nearest end
+    of it; otherwise top-left.
+    """
+    rows = []
+    for pos in sorted(positions, key=lambda p: (p[1], p[0])):
+        if rows and abs(pos[1] - rows[-1][0][1]) <= row_tolerance:
+            rows[-1].append(pos)
+        else:
+            rows.append([pos])
+    for row in rows:
+        row.sort()
+    left_first = True
+    if start is not None and rows:
+        if abs(start[1] - rows[-1][0][1]) < abs(start[1] - rows[0][0][1]):
+            rows.reverse()
+        left_first = abs(start[0] - rows[0][0][0]) <= abs(start[0] - rows[0][-1][0])
+    ordered = []
+    for row in rows:
+        ordered += row if left_first else row[::-1]
+        left_first = not left_first
+    return ordered
+
+
+def plan_transfer(positions, take_all=False, strategies=TRANSFER_STRATEGIES, start=None, row_tolerance=20):
+    """Cheapest gestures that shift-move every position: [(strategy, [positions])].
+
+    'double' is one shift+double-click, which moves every stack of the same
+    item, so it is only chosen when take_all says every filled slot may go.
+    'drag' holds the button across one row; passing over an empty slot does
+    nothing, so a row's targets only need to be the leftmost filled ones,
+    which is how callers slice them. 'click' is one shift-click per slot.
+    Costs are the gestures' input delays in seconds.
+    """
+    if not positions:
+        return []
+    if take_all and 'double' in strategies and len(positions) > 1:
+        return [('double', [serpentine_order(positions, start, row_tolerance)[0]])]
+    click_cost = SLOT_HOVER_DELAY + SLOT_CLICK_DELAY
+    gestures = []
+    row = []
+    for pos in serpentine_order(positions, start, row_tolerance) + [None]:
+        if row and (pos is None or abs(pos[1] - row[0][1]) > row_tolerance):
+            drag_cost = SLOT_HOVER_DELAY + DRAG_STEP_DELAY * len(row) + SLOT_CLICK_DELAY
+            if 'drag' in strategies and len(row) > 1 and drag_cost < click_cost * len(row):
+                gestures.append(('drag', row))
+            else:
+                gestures += [('click', [p]) for p in row]
+            row = []
+        if pos is not None:
+            row.append(pos)
+    return gestures
+
+
+def pause(seconds):
+    """time.sleep that shows up as a 'sleep' span in timings and traces."""
+    if not STAGE_TIMER.enabled:
+        time.sleep(seconds)
+        return
+    started = time.perf_counter()
+    time.sleep(seconds)
+    STAGE_TIMER.record('sleep', started, time.perf_counter())
+
+
 # UI palette
 _CLR_RED = "#3b82f6"
 _CLR_WHITE = "#d4e4f7"
@@ -332,8 +689,622 @@ class ScrollPresetField(QLineEdit):
         event.accept()
 
 
-class HotbarDetector:
+class LayoutProfile:
+    """Maps reference-layout coordinates onto the current client area and GUI scale.
+
+    Every box and click point is defined once on the reference layout
+    (LAYOUT_BOXES / LAYOUT_POINTS) and scaled by gui_scale / REFERENCE_GUI_SCALE
+    around its anchor: the client centre for containers, the bottom centre
+    for the hotbar.
+    """
+
+    FILENAME = 'layout_profile.json'
+
+    def __init__(self, gui_scale=REFERENCE_GUI_SCALE, anchors=None, client=None):
+        self.gui_scale = gui_scale
+        self.anchors = dict(REFERENCE_ANCHORS)
+        if anchors:
+            self.anchors.update({k: tuple(v) for k, v in anchors.items()})
+        self.client = tuple(client) if client else None
+
+    @property
+    def factor(self):
+        return self.gui_scale / REFERENCE_GUI_SCALE
+
+    def point(self, x, y, anchor='center'):
+        ref_x, ref_y = REFERENCE_ANCHORS[anchor]
+        ax, ay = self.anchors[anchor]
+        k = self.factor
+        return int(round(ax + (x - ref_x) * k)), int(round(ay + (y - ref_y) * k))
+
+    def box(self, name):
+        (x1, y1, x2, y2), anchor = LAYOUT_BOXES[name]
+        left, top = self.point(x1, y1, anchor)
+        right, bottom = self.point(x2, y2, anchor)
+        return left, top, right, bottom
+
+    def click(self, name):
+        (x, y), anchor = LAYOUT_POINTS[name]
+        return self.point(x, y, anchor)
+
+    def capture_bbox(self):
+        """Union of every layout box: the area ScreenCapture grabs each tick."""
+        boxes = [self.box(name) for name in LAYOUT_BOXES]
+        return (min(b[0] for b in boxes), min(b[1] for b in boxes),
+                max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+    def to_dict(self):
+        return {
+            'gui_scale': self.gui_scale,
+            'anchors': {k: list(v) for k, v in self.anchors.items()},
+            'client': list(self.client) if self.client else None,
+        }
+
+    @classmethod
+    def load(cls):
+        data = load_json_cache(cls.FILENAME)
+        try:
+            return cls(data['gui_scale'], data.get('anchors'), data.get('client'))
+        except (KeyError, TypeError, ValueError):
+            return cls()
+
+    def save(self):
+        save_json_cache(self.FILENAME, self.to_dict())
+
+
+class LayoutCalibrator:
+    """Builds a LayoutProfile from the Minecraft client area and the hotbar sprite.
+
+    The client rect comes from Win32; the GUI scale is the scale at which the
+    182x22 hotbar sprite's outline lines up in a grab of the client's bottom
+    band, falling back to Minecraft's auto GUI-scale rule.
+    """
+
+    MAX_GUI_SCALE = 8
+    MIN_HOTBAR_EDGE = 25.0
+    # Client sizes this close to the reference keep the measured coordinates unchanged.
+    REFERENCE_TOLERANCE = 40
+
+    def __init__(self, capture):
+        self.capture = capture
+
+    @classmethod
+    def auto_gui_scale(cls, width, height):
+        scale = 1
+        while (scale < cls.MAX_GUI_SCALE and width // (scale + 1) >= 320
+               and height // (scale + 1) >= 240):
+            scale += 1
+        return scale
+
+    @staticmethod
+    def hotbar_rect(width, height, scale):
+        """Hotbar sprite (x1, y1, x2, y2) in client pixels, placed the way Minecraft does."""
+        scaled_w = -(-width // scale)
+        scaled_h = -(-height // scale)
+        x1 = (scaled_w // 2 - 91) * scale
+        y1 = (scaled_h - 22) * scale
+        return x1, y1, x1 + 182 * scale, y1 + 22 * scale
+
+    def find_hotbar_scale(self, band, width, height):
+        """Scale whose hotbar outline has the strongest edges in band (the client's bottom rows)."""
+        gray = cv2.cvtColor(band, cv2.COLOR_BGR2GRAY).astype(np.int16)
+        band_top = height - gray.shape[0]
+        best_scale, best_score = None, self.MIN_HOTBAR_EDGE
+        for scale in range(1, self.MAX_GUI_SCALE + 1):
+            x1, y1, x2, y2 = self.hotbar_rect(width, height, scale)
+            y1 -= band_top
+            y2 = min(y2 - band_top, gray.shape[0])
+            if x1 < 1 or x2 >= width or y1 < 1 or y2 - y1 < 3 * scale:
+                continue
+            rows = slice(y1 + scale, y2 - scale)
+            score = (
+                np.abs(gray[rows, x1] - gray[rows, x1 - 1]).mean()
+                + np.abs(gray[rows, x2 - 1] - gray[rows, x2]).mean()
+                + np.abs(gray[y1, x1:x2] - gray[y1 - 1, x1:x2]).mean()
+            ) / 3
+            if score > best_score:
+                best_scale, best_score = scale, score
+        return best_scale
+
+    def calibrate(self):
+        """Profile for the current client area, or None when no Minecraft window is found."""
+        client = get_minecraft_client_rect()
+        if client is None:
+            return None
+        x1, y1, x2, y2 = client
+        width, height = x2 - x1, y2 - y1
+        if width < 320 or height < 240:
+            return None
+        band_h = min(height, 24 * self.MAX_GUI_SCALE)
+        scale = None
+        try:
+            band = self.capture.grab_once(x1, y2 - band_h, x2, y2)
+            scale = self.find_hotbar_scale(band, width, height)
+        except Exception as e:
+            print(f"Hotbar calibration error: {e}")
+        if scale is None:
+            scale = self.auto_gui_scale(width, height)
+        ref_w, ref_h = REFERENCE_CLIENT_SIZE
+        if (scale == REFERENCE_GUI_SCALE and abs(width - ref_w) <= self.REFERENCE_TOLERANCE
+                and abs(height - ref_h) <= self.REFERENCE_TOLERANCE):
+            return LayoutProfile(client=client)
+        anchors = {
+            'center': ((x1 + x2) / 2, (y1 + y2) / 2),
+            'bottom': ((x1 + x2) / 2, y2),
+        }
+        return LayoutProfile(scale, anchors, client)
+
+
+class Frame:
+    """One BGR screen grab; timestamp is time.monotonic() when the grab finished."""
+
+    __slots__ = ("image", "left", "top", "timestamp", "seq")
+
+    def __init__(self, image, left, top, timestamp, seq):
+        self.image = image
+        self.left = left
+        self.top = top
+        self.timestamp = timestamp
+        self.seq = seq
+
+    def contains(self, x1, y1, x2, y2):
+        h, w = self.image.shape[:2]
+        return (x1 >= self.left and y1 >= self.top and
+                x2 <= self.left + w and y2 <= self.top + h)
+
+    def view(self, x1, y1, x2, y2):
+        """Crop in screen coordinates. Returns a view into the shared frame, not a copy."""
+        return self.image[y1 - self.top:y2 - self.top, x1 - self.left:x2 - self.left]
+
+
+class LiveFrameSource:
+    """Desktop grabs through mss. open() runs on the thread that will call grab()."""
+
     def __init__(self):
+        self._sct = None
+
+    def open(self):
+        # mss keeps GDI handles per thread on Windows, so each grabbing thread opens its own.
+        self._sct = mss()
+
+    def close(self):
+        if self._sct is not None:
+            self._sct.close()
+            self._sct = None
+
+    @staticmethod
+    def _grab(sct, bbox):
+        x1, y1, x2, y2 = bbox
+        shot = sct.grab({'left': x1, 'top': y1, 'width': x2 - x1, 'height': y2 - y1})
+        return cv2.cvtColor(np.asarray(shot), cv2.COLOR_BGRA2BGR), x1, y1
+
+    def grab(self, bbox):
+        """(BGR image, left, top) of bbox."""
+        return self._grab(self._sct, bbox)
+
+    def grab_once(self, bbox):
+        with mss() as sct:
+            return self._grab(sct, bbox)
+
+
+class ReplayFrameSource:
+    """Recorded frames instead of the desktop, for profiling and tests off a live client.
+
+    path is either a directory of PNGs (sorted by name; an optional frames.json
+    lists {"file", "t", "left", "top"} per frame) or a .npz archive with
+    images (N, h, w, 3) BGR, timestamps (N,) and origins (N, 2). Frames without
+    an origin are assumed to cover CAPTURE_BBOX. Each grab() returns the next
+    frame; at the end it wraps when loop=True, else keeps returning the last one.
+    """
+
+    def __init__(self, path, loop=False):
+        self.path = path
+        self.loop = loop
+        self.index = -1
+        self.exhausted = False
+        self._images = None
+        if os.path.isdir(path):
+            self._entries = self._read_directory(path)
+        else:
+            with np.load(path) as archive:
+                self._images = archive['images']
+                count = len(self._images)
+                timestamps = (archive['timestamps'] if 'timestamps' in archive.files
+                              else np.arange(count) / CAPTURE_FPS)
+                origins = (archive['origins'] if 'origins' in archive.files
+                           else np.tile(CAPTURE_BBOX[:2], (count, 1)))
+            self._entries = [
+                {'t': float(t), 'left': int(o[0]), 'top': int(o[1])}
+                for t, o in zip(timestamps, origins)
+            ]
+        if not self._entries:
+            raise ValueError(f"No frames in {path}")
+
+    @staticmethod
+    def _read_directory(path):
+        index_path = os.path.join(path, 'frames.json')
+        if os.path.exists(index_path):
+            with open(index_path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)['frames']
+        else:
+            names = sorted(n for n in os.listdir(path) if n.lower().endswith('.png'))
+            entries = [{'file': n, 't': i / CAPTURE_FPS} for i, n in enumerate(names)]
+        for entry in entries:
+            entry['file'] = os.path.join(path, entry['file'])
+            entry.setdefault('left', CAPTURE_BBOX[0])
+            entry.setdefault('top', CAPTURE_BBOX[1])
+        return entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def timestamp(self):
+        """Recorded time of the current frame."""
+        return self._entries[max(self.index, 0)]['t']
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _image(self, idx):
+        if self._images is not None:
+            return self._images[idx]
+        img = cv2.imread(self._entries[idx]['file'], cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError(f"Unreadable frame {self._entries[idx]['file']}")
+        return img
+
+    def _current(self, bbox):
+        entry = self._entries[self.index]
+        img = self._image(self.index)
+        left, top = entry['left'], entry['top']
+        x1, y1, x2, y2 = bbox
+        h, w = img.shape[:2]
+        if x1 >= left and y1 >= top and x2 <= left + w and y2 <= top + h:
+            return img[y1 - top:y2 - top, x1 - left:x2 - left], x1, y1
+        return img, left, top
+
+    def grab(self, bbox):
+        if self.index + 1 < len(self._entries):
+            self.index += 1
+        elif self.loop:
+            self.index = 0
+        else:
+            self.exhausted = True
+        return self._current(bbox)
+
+    def grab_once(self, bbox):
+        """Crop of the current frame; replay does not advance for out-of-band grabs."""
+        img, left, top = self._current(bbox) if self.index >= 0 else self.grab(bbox)
+        x1, y1, x2, y2 = bbox
+        if (left, top) != (x1, y1) or img.shape[:2] != (y2 - y1, x2 - x1):
+            raise ValueError(f"bbox {bbox} is outside the recorded frame")
+        return img, left, top
+
+
+class ScreenCapture:
+    """Long-lived grabber shared by every detector.
+
+    One thread grabs CAPTURE_BBOX per tick from a single frame source (live
+    mss by default) and converts it to BGR once; detectors read views of the
+    latest frame instead of each opening their own grab. Frames are read-only —
+    copy before drawing. With threaded=False nothing runs in the background and
+    the caller steps frames with advance(), e.g. to replay recordings at full speed.
+    Once no frame has been read for IDLE_AFTER_S the thread only grabs every
+    IDLE_INTERVAL; the next read wakes it back to full rate.
+    """
+
+    IDLE_AFTER_S = 1.0
+    IDLE_INTERVAL = 0.5
+
+    def __init__(self, bbox=CAPTURE_BBOX, fps=CAPTURE_FPS, source=None, threaded=True):
+        self.bbox = bbox
+        self.interval = 1.0 / fps
+        self.source = source if source is not None else LiveFrameSource()
+        self.threaded = threaded
+        self._frame = None
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._running = False
+        self._closed = False
+        self._thread = None
+        self._read_at = time.monotonic()
+        self._wake = threading.Event()
+        self.recorder = None
+
+    def start(self):
+        with self._cond:
+            if self._running or self._closed or not self.threaded:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._capture_loop, name="capture", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._closed = True
+            self._cond.notify_all()
+        self._wake.set()
+
+    def set_bbox(self, bbox):
+        """Change the shared capture area; takes effect from the next tick."""
+        self.bbox = tuple(int(v) for v in bbox)
+
+    def _publish(self, img, left, top):
+        if img.flags.writeable:
+            img.flags.writeable = False
+        with self._cond:
+            self._seq += 1
+            self._frame = Frame(img, left, top, time.monotonic(), self._seq)
+            self._cond.notify_all()
+            return self._frame
+
+    @timed('capture.grab')
+    def advance(self):
+        """Grab and publish one frame on the calling thread."""
+        img, left, top = self.source.grab(self.bbox)
+        return self._publish(img, left, top)
+
+    def _capture_loop(self):
+        try:
+            self.source.open()
+        except Exception as e:
+            print(f"ScreenCapture init error: {e}")
+            with self._cond:
+                self._running = False
+                self._cond.notify_all()
+            return
+        try:
+            while self._running:
+                started = time.monotonic()
+                try:
+                    self.advance()
+                except Exception as e:
+                    print(f"ScreenCapture error: {e}")
+                    time.sleep(0.1)
+                    continue
+                idle = time.monotonic() - self._read_at > self.IDLE_AFTER_S
+                remaining = (self.IDLE_INTERVAL if idle else self.interval) - (time.monotonic() - started)
+                if remaining > 0:
+                    self._wake.wait(remaining)
+                    self._wake.clear()
+        finally:
+            self.source.close()
+
+    def _mark_read(self):
+        now = time.monotonic()
+        if now - self._read_at > self.IDLE_AFTER_S:
+            self._wake.set()
+        self._read_at = now
+
+    def latest(self, max_age=None, timeout=0.5):
+        """Latest frame no older than max_age seconds (default two ticks), or None if none arrives in time."""
+        if not self.threaded:
+            return self._frame if self._frame is not None else self.advance()
+        if max_age is None:
+            max_age = 2 * self.interval
+        self._mark_read()
+        self.start()
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                frame = self._frame
+                now = time.monotonic()
+                if frame is not None and now - frame.timestamp <= max_age:
+                    return frame
+                if now >= deadline or not self._running:
+                    return None
+                self._cond.wait(deadline - now)
+
+    def wait_for_frame(self, timeout):
+        """Block until a newer frame is published or timeout passes; without a capture thread, wait one tick."""
+        if not self.threaded or not self._running:
+            pause(min(timeout, self.interval))
+            return
+        self._mark_read()
+        with self._cond:
+            seq = self._seq
+            self._cond.wait_for(lambda: self._seq != seq or not self._running, timeout)
+
+    @timed('capture.region')
+    def region(self, x1, y1, x2, y2, max_age=None):
+        """BGR image of a screen box; falls back to a one-off grab outside the shared frame."""
+        frame = self.latest(max_age)
+        if frame is not None and frame.contains(x1, y1, x2, y2):
+            img, seq = frame.view(x1, y1, x2, y2), frame.seq
+        else:
+            img, seq = self.grab_once(x1, y1, x2, y2), None
+        if self.recorder is not None:
+            self.recorder.frame_read(seq, (x1, y1, x2, y2), img)
+        return img
+
+    def grab_once(self, x1, y1, x2, y2):
+        return self.source.grab_once((x1, y1, x2, y2))[0]
+
+
+class FrameChangeGate:
+    """Tells a polling loop whether a capture differs from the last one it analyzed.
+
+    Compares every STEP-th pixel (a strided copy, no resampling) against the
+    previous analyzed capture; a static screen is skipped until MAX_SKIP_S
+    passes, so a missed change is re-checked at least that often.
+    """
+
+    STEP = 4
+    TOLERANCE = 24
+    MAX_SKIP_S = 1.0
+
+    def __init__(self):
+        self._thumb = None
+        self._key = None
+        self._passed_at = 0.0
+
+    def changed(self, img, key=None):
+        thumb = np.ascontiguousarray(img[::self.STEP, ::self.STEP])
+        now = time.monotonic()
+        if (self._thumb is not None and key == self._key and thumb.shape == self._thumb.shape
+                and now - self._passed_at < self.MAX_SKIP_S
+                and cv2.norm(thumb, self._thumb, cv2.NORM_INF) <= self.TOLERANCE):
+            return False
+        self._thumb = thumb
+        self._key = key
+        self._passed_at = now
+        return True
+
+
+class ScreenState:
+    """Which container GUI is open ('order' / 'backpack' / 'chest' or None) plus every template score."""
+
+    __slots__ = ("gui", "scores", "threshold")
+
+    def __init__(self, scores, threshold=GUI_TEMPLATE_THRESHOLD):
+        self.scores = scores
+        self.threshold = threshold
+        self.gui = next(
+            (name for name in GUI_STATE_PRIORITY if scores.get(name, 0.0) >= threshold),
+            None,
+        )
+
+    def is_open(self, gui):
+        """True when gui's template matched, regardless of priority."""
+        return self.scores.get(gui, 0.0) >= self.threshold
+
+
+class GuiSignature:
+    """Sentinel pixels of one GUI template at the spot it last fully matched.
+
+    check() samples a fixed grid of template pixels at that spot in O(1);
+    only an ambiguous difference (or a periodic recheck) needs matchTemplate.
+    """
+
+    GRID = 6
+    MATCH_DIFF = 15
+    REJECT_DIFF = 45
+    RECHECK_S = 2.0
+
+    def __init__(self, template_bgr):
+        th, tw = template_bgr.shape[:2]
+        ys = np.linspace(2, th - 3, self.GRID).astype(np.intp)
+        xs = np.linspace(2, tw - 3, self.GRID).astype(np.intp)
+        grid_y, grid_x = np.meshgrid(ys, xs, indexing='ij')
+        self.ys = grid_y.ravel()
+        self.xs = grid_x.ravel()
+        self.expected = template_bgr[self.ys, self.xs].astype(np.int16)
+        self.origin = None
+        self.score = 0.0
+        self.checked_at = 0.0
+
+    def learn(self, origin, score):
+        self.origin = (int(origin[0]), int(origin[1]))
+        self.score = float(score)
+
+    def check(self, img):
+        """True / False when the sentinels are decisive, None when a full match is needed."""
+        if self.origin is None:
+            return None
+        x, y = self.origin
+        ys = self.ys + y
+        xs = self.xs + x
+        if ys[-1] >= img.shape[0] or xs[-1] >= img.shape[1]:
+            return None
+        diff = np.abs(img[ys, xs].astype(np.int16) - self.expected).mean()
+        if diff <= self.MATCH_DIFF:
+            return True
+        if diff >= self.REJECT_DIFF and time.monotonic() - self.checked_at < self.RECHECK_S:
+            return False
+        return None
+
+
+class SlotGeometryCache:
+    """Slot rectangles per container region, calibrated once and revalidated with edge probes.
+
+    The container grid does not move between frames, so a full Canny/contour
+    pass is only needed when the region size changes or the probes (mean of
+    the top/left border lines of a few slots) stop matching. The chest
+    monitor and the automation both use one cache, so entries change and
+    are saved under a lock.
+    """
+
+    FILENAME = 'slot_geometry.json'
+    FULL_GRID = 27
+    PROBE_TOLERANCE = 18
+    PROBE_SLOTS = (0, 8, 13, 18, 26)
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        for region, entry in load_json_cache(self.FILENAME).items():
+            try:
+                self._entries[region] = {
+                    'shape': tuple(entry['shape']),
+                    'rects': [tuple(r) for r in entry['rects']],
+                    'probes': np.asarray(entry['probes'], dtype=np.float32),
+                }
+            except (KeyError, TypeError, ValueError):
+                continue
+
+    @classmethod
+    def _probes(cls, img, rects):
+        values = []
+        for idx in cls.PROBE_SLOTS:
+            if idx >= len(rects):
+                continue
+            x, y, w, h = rects[idx]
+            # One pixel outside the rect: the slot border, which item icons never cover.
+            values.append(img[max(y - 1, 0), x:x + w].mean())
+            values.append(img[y:y + h, max(x - 1, 0)].mean())
+        return np.asarray(values, dtype=np.float32)
+
+    def get(self, region, img):
+        """Cached rects for region if img still shows the same grid, else None."""
+        with self._lock:
+            entry = self._entries.get(region)
+            if entry is None or entry['shape'] != img.shape[:2]:
+                return None
+            rects, expected = entry['rects'], entry['probes']
+        probes = self._probes(img, rects)
+        if probes.shape != expected.shape:
+            return None
+        if np.abs(probes - expected).max() > self.PROBE_TOLERANCE:
+            return None
+        return rects
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def store(self, region, img, rects):
+        """Remember a freshly detected grid; partial detections are never cached."""
+        if len(rects) < self.FULL_GRID:
+            return
+        rects = [tuple(int(v) for v in r) for r in rects[:self.FULL_GRID]]
+        probes = self._probes(img, rects)
+        with self._lock:
+            entry = self._entries.get(region)
+            if entry is not None and entry['rects'] == rects and entry['shape'] == img.shape[:2]:
+                entry['probes'] = probes
+                return
+            self._entries[region] = {
+                'shape': img.shape[:2],
+                'rects': rects,
+                'probes': probes,
+            }
+            save_json_cache(self.FILENAME, {
+                name: {
+                    'shape': list(e['shape']),
+                    'rects': [list(r) for r in e['rects']],
+                    'probes': [float(v) for v in e['probes']],
+                }
+                for name, e in self._entries.items()
+            })
+
+
+class HotbarDetector:
+    def __init__(self, capture=None):
         self.hotbar_region = {
             'left': 600,
             'top': 933,
@@ -342,37 +1313,95 @@ class HotbarDetector:
         }
         self.num_slots = 9
         self.slot_width = self.hotbar_region['width'] / self.num_slots
+        self.block_variance = 1000
+        self.capture = capture if capture is not None else ScreenCapture()
+        self._layout_shape = None
+        self._layout = None
+
+    def apply_layout(self, profile):
+        x1, y1, x2, y2 = profile.box('hotbar')
+        self.hotbar_region = {'left': x1, 'top': y1, 'width': x2 - x1, 'height': y2 - y1}
+        self.slot_width = self.hotbar_region['width'] / self.num_slots
+        self._layout_shape = None
 
     def capture_hotbar(self):
+        r = self.hotbar_region
         try:
-            with mss() as sct:
-                screenshot = sct.grab(self.hotbar_region)
-                img = np.array(screenshot)
-                img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
-                return img
+            return self.capture.region(
+                r['left'], r['top'], r['left'] + r['width'], r['top'] + r['height']
+            )
         except Exception as e:
             print(f"Error capturing hotbar: {e}")
             return None
 
-    def find_selected_slot(self, img):
+    def _slot_layout(self, shape):
+        """Slot column bounds and centre-crop indices for one capture shape (cached)."""
+        if self._layout_shape == shape[:2]:
+            return self._layout
+        h, w = shape[:2]
+        bounds = np.array([int(i * self.slot_width) for i in range(self.num_slots + 1)])
+        starts = bounds[:-1]
+        ends = bounds[1:]
+        valid = (starts < w) & (ends <= w)
+        starts_c = np.minimum(starts, w)
+        ends_c = np.minimum(ends, w)
+        # Centre crop per slot (middle half in both axes), same bounds as analyze_slot.
+        widths = ends_c - starts_c
+        c0 = starts_c + (widths * 0.25).astype(int)
+        c1 = starts_c + (widths * 0.75).astype(int)
+        centre_cols = None
+        if np.all(c1 - c0 == c1[0] - c0[0]) and c1[0] > c0[0]:
+            centre_cols = (c0[:, None] + np.arange(c1[0] - c0[0])).ravel()
+        self._layout = {
+            'starts': starts_c,
+            'ends': ends_c,
+            'valid': valid,
+            'left_end': np.minimum(starts_c + 5, ends_c),
+            'right_start': np.maximum(starts_c, ends_c - 5),
+            'rows': (int(h * 0.25), int(h * 0.75)),
+            'centre_cols': centre_cols,
+        }
+        self._layout_shape = shape[:2]
+        return self._layout
+
+    @timed('hotbar.analyze')
+    def analyze_hotbar(self, img):
+        """All nine slots in one pass: returns (selected_slot, variances as a (9,) float array).
+
+        The strip is converted to grayscale once; edge brightness comes from
+        prefix sums over thresholded columns and the centre variances from a
+        single (h, 9, w) gather instead of per-slot slicing.
+        """
+        layout = self._slot_layout(img.shape)
         gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        _, thresh = cv2.threshold(gray, 200, 255, cv2.THRESH_BINARY)
-        max_brightness = 0
-        selected_slot = -1
-        for slot_idx in range(self.num_slots):
-            slot_x_start = int(slot_idx * self.slot_width)
-            slot_x_end = int((slot_idx + 1) * self.slot_width)
-            top_edge = thresh[0:8, slot_x_start:slot_x_end]
-            bottom_edge = thresh[-8:, slot_x_start:slot_x_end]
-            if slot_x_start < thresh.shape[1] and slot_x_end <= thresh.shape[1]:
-                left_edge = thresh[:, slot_x_start:min(slot_x_start+5, slot_x_end)]
-                right_edge = thresh[:, max(slot_x_start, slot_x_end-5):slot_x_end]
-                total_brightness = (np.sum(top_edge) + np.sum(bottom_edge) +
-                                    np.sum(left_edge) + np.sum(right_edge))
-                if total_brightness > max_brightness and total_brightness > 2000:
-                    max_brightness = total_brightness
-                    selected_slot = slot_idx
-        return selected_slot
+
+        bright = gray > 200
+        prefix = np.zeros((3, bright.shape[1] + 1), dtype=np.int64)
+        np.cumsum(bright[0:8].sum(axis=0), out=prefix[0, 1:])
+        np.cumsum(bright[-8:].sum(axis=0), out=prefix[1, 1:])
+        np.cumsum(bright.sum(axis=0), out=prefix[2, 1:])
+        s, e = layout['starts'], layout['ends']
+        totals = 255 * (
+            (prefix[0, e] - prefix[0, s])
+            + (prefix[1, e] - prefix[1, s])
+            + (prefix[2, layout['left_end']] - prefix[2, s])
+            + (prefix[2, e] - prefix[2, layout['right_start']])
+        )
+        totals[~layout['valid']] = 0
+        selected = int(np.argmax(totals)) if totals.max() > 2000 else -1
+
+        r0, r1 = layout['rows']
+        cols = layout['centre_cols']
+        if cols is not None and r1 > r0:
+            centre = gray[r0:r1, cols].reshape(r1 - r0, self.num_slots, -1)
+            variances = centre.var(axis=(0, 2))
+        else:
+            variances = np.array([self.analyze_slot(img, i)[1] for i in range(self.num_slots)],
+                                 dtype=np.float64)
+        return selected, variances
+
+    def find_selected_slot(self, img):
+        return self.analyze_hotbar(img)[0]
 
     def analyze_slot(self, img, slot_idx):
         if slot_idx < 0 or slot_idx >= self.num_slots:
@@ -390,98 +1419,36 @@ class HotbarDetector:
             return (False, 0)
         gray = cv2.cvtColor(center_region, cv2.COLOR_BGR2GRAY)
         variance = np.var(gray)
-        has_block = variance > 1000
+        has_block = variance > self.block_variance
         return (has_block, variance)
 
-    def analyze_all_slots(self, img):
-        results = []
-        for i in range(self.num_slots):
-            has_block, variance = self.analyze_slot(img, i)
-            results.append((has_block, variance))
-        return results
+    def slot_results(self, variances):
+        """(has_block, variance) per slot, the list shape the overlay signals carry."""
+        return [(bool(v > self.block_variance), float(v)) for v in variances]
 
-    def check_any_slot_has_block(self):
-        img = self.capture_hotbar()
-        if img is None:
-            return False, 0
-        results = self.analyze_all_slots(img)
-        for has_block, variance in results:
-            if has_block:
-                return True, variance
-        return False, 0
-
-    def count_block_slots(self):
-        img = self.capture_hotbar()
-        if img is None:
-            return 0
-        results = self.analyze_all_slots(img)
-        return sum(1 for has_block, _ in results if has_block)
+    def analyze_all_slots(self, img):
+        return self.slot_results(self.analyze_hotbar(img)[1])
 
-    def scroll_to_block_slot(self, mouse_ctrl):
+    def read_slots(self):
+        """[has_block] * 9 from one hotbar read, or None without a frame."""
         img = self.capture_hotbar()
         if img is None:
-            return False
-
-        results = self.analyze_all_slots(img)
-        block_indices = [i for i, (has_block, _) in enumerate(results) if has_block]
-        if not block_indices:
-            return False
-
-        selected = self.find_selected_slot(img)
-        if selected == -1:
-            selected = 0
-
-        if selected in block_indices:
-            return True
-
-        # Prefer the block reachable in the fewest scroll steps (shortest path on 1–9 ring).
-        n = self.num_slots
-        target_idx = min(
-            block_indices,
-            key=lambda idx: min((idx - selected) % n, (selected - idx) % n),
-        )
-
-        # Minecraft selects hotbar via keys 1–9; wheel scroll often fails after /order or chat focus.
-        pyautogui.press(str(target_idx + 1))
-        time.sleep(0.12)
-        key_img = self.capture_hotbar()
-        if key_img is not None:
-            if self.find_selected_slot(key_img) == target_idx:
-                return True
-            has_b, _ = self.analyze_slot(key_img, target_idx)
-            if has_b:
-                return True
-
-        # scroll(0, -1) moves selection toward the next slot to the right (index +1 mod n).
-        # scroll(0, 1) moves toward the left (index -1 mod n).
-        max_moves = n + 2
-        for _ in range(max_moves):
-            current_img = self.capture_hotbar()
-            if current_img is None:
-                return False
-            current_selected = self.find_selected_slot(current_img)
-            if current_selected == -1:
-                current_selected = selected
-            if current_selected == target_idx:
-                return True
-
-            forward = (target_idx - current_selected) % n
-            backward = (current_selected - target_idx) % n
-            if forward <= backward:
-                mouse_ctrl.scroll(0, -1)
-            else:
-                mouse_ctrl.scroll(0, 1)
-            time.sleep(0.2)
-
-        final_img = self.capture_hotbar()
-        if final_img is None:
-            return False
-        final_selected = self.find_selected_slot(final_img)
-        return final_selected == target_idx
+            return None
+        _, variances = self.analyze_hotbar(img)
+        return (variances > self.block_variance).tolist()
 
 
 class InventoryDetector:
-    def __init__(self):
+    GUI_SIGNATURE_CACHE = 'gui_signatures.json'
+    PAPER_SCALES = (0.5, 0.6, 0.7, 0.8, 0.9, 1.0, 1.1, 1.2, 1.3, 1.4, 1.5)
+    # A locked paper scale is trusted unless its score lands this close below the threshold.
+    PAPER_LOCK_MARGIN = 0.2
+    # Slot fingerprints are the slot on a 1/4-size copy of the region; any cell moving
+    # more than this marks the slot as changed and due for re-classification.
+    FINGERPRINT_STEP = 4
+    FINGERPRINT_TOLERANCE = 12
+
+    def __init__(self, capture=None):
         self.x1 = 635
         self.y1 = 255
         self.x2 = 1283
@@ -503,7 +1470,23 @@ class InventoryDetector:
         self.order_template = None
         self.paper_template = None
         self.paper_template_gray = None
+        self.paper_pyramid = []
+        # Slot ROI shape (i.e. GUI scale) -> pyramid index that last matched paper.
+        self.paper_scale_lock = {}
         self.paper_match_threshold = 0.6
+        # Correlate the locked paper scale once over the whole container instead of per slot.
+        self.batched_paper_matching = True
+        # region -> {rect: (fingerprint, measure)} from the previous analysis of that region.
+        self._slot_memo = {}
+        # BGR copies of the GUI templates keyed by screen state, converted once at load. apply_layout
+        # swaps both under _gui_lock while the chest-monitor thread may be classifying.
+        self.gui_templates = {}
+        self.gui_signatures = {}
+        self._gui_lock = threading.Lock()
+        self.gui_bbox = GUI_TEMPLATE_BBOX
+        self.gui_scale_factor = 1.0
+        self.slot_geometry = SlotGeometryCache()
+        self.capture = capture if capture is not None else ScreenCapture()
 
         self.load_templates()
 
@@ -526,175 +1509,1797 @@ class InventoryDetector:
                 if len(self.paper_template.shape) == 3 and self.paper_template.shape[2] == 4:
                     self.paper_template = cv2.cvtColor(self.paper_template, cv2.COLOR_BGRA2BGR)
                 self.paper_template_gray = cv2.cvtColor(self.paper_template, cv2.COLOR_BGR2GRAY)
+                self.paper_pyramid = self._build_paper_pyramid(self.paper_template_gray)
         except Exception as e:
             print(f"Error loading paper template: {e}")
+        self._prepare_gui_templates()
+
+    def _prepare_gui_templates(self):
+        """BGR GUI templates at the current GUI scale, plus their learned pixel signatures."""
+        templates = {}
+        signatures = {}
+        for name, template in (('order', self.order_template),
+                               ('backpack', self.hijau_template),
+                               ('chest', self.book_template)):
+            if template is None:
+                continue
+            template_bgr = self._as_bgr(template)
+            if self.gui_scale_factor != 1.0:
+                # GUI art is pixel-exact at every integer scale, so nearest-neighbour keeps it sharp.
+                template_bgr = cv2.resize(
+                    template_bgr, None, fx=self.gui_scale_factor, fy=self.gui_scale_factor,
+                    interpolation=cv2.INTER_NEAREST,
+                )
+            templates[name] = template_bgr
+            signatures[name] = GuiSignature(template_bgr)
+        learned = load_json_cache(self.GUI_SIGNATURE_CACHE).get(str(list(self.gui_bbox)), {})
+        for name, entry in learned.items():
+            if name in signatures:
+                signatures[name].learn(entry['origin'], entry['score'])
+        with self._gui_lock:
+            self.gui_templates = templates
+            self.gui_signatures = signatures
+
+    def apply_layout(self, profile):
+        self.x1, self.y1, self.x2, self.y2 = profile.box('chest')
+        self.order_x1, self.order_y1, self.order_x2, self.order_y2 = profile.box('order')
+        self.bp_x1, self.bp_y1, self.bp_x2, self.bp_y2 = profile.box('backpack')
+        self.gui_bbox = profile.box('gui')
+        self.gui_scale_factor = profile.factor
+        self._slot_memo = {}
+        self._prepare_gui_templates()
+
+    @classmethod
+    def _build_paper_pyramid(cls, template_gray):
+        """Paper template resized once per scale in PAPER_SCALES (too-small scales dropped)."""
+        pyramid = []
+        for scale in cls.PAPER_SCALES:
+            width = int(template_gray.shape[1] * scale)
+            height = int(template_gray.shape[0] * scale)
+            if width < 5 or height < 5:
+                continue
+            pyramid.append(cv2.resize(template_gray, (width, height)))
+        return pyramid
+
+    @staticmethod
+    def _as_bgr(template):
+        if len(template.shape) == 3 and template.shape[2] == 4:
+            return cv2.cvtColor(template, cv2.COLOR_BGRA2BGR)
+        return template
+
+    @staticmethod
+    def _template_match(screenshot_cv, template_bgr):
+        if (template_bgr.shape[0] > screenshot_cv.shape[0] or
+                template_bgr.shape[1] > screenshot_cv.shape[1]):
+            return 0.0, None
+        result = cv2.matchTemplate(screenshot_cv, template_bgr, cv2.TM_CCOEFF_NORMED)
+        _, max_val, _, max_loc = cv2.minMaxLoc(result)
+        return max_val, max_loc
+
+    @classmethod
+    def _template_score(cls, screenshot_cv, template_bgr):
+        return cls._template_match(screenshot_cv, template_bgr)[0]
+
+    def _gui_score(self, name, screenshot_cv):
+        """Template score for one GUI, answered by its pixel signature when decisive."""
+        signature = self.gui_signatures[name]
+        verdict = signature.check(screenshot_cv)
+        if verdict is True:
+            return signature.score
+        if verdict is False:
+            return 0.0
+        score, loc = self._template_match(screenshot_cv, self.gui_templates[name])
+        signature.checked_at = time.monotonic()
+        if score >= GUI_TEMPLATE_THRESHOLD and loc != signature.origin:
+            signature.learn(loc, score)
+            self._save_gui_signatures()
+        return score
+
+    def _save_gui_signatures(self):
+        learned = {
+            name: {'origin': list(sig.origin), 'score': sig.score}
+            for name, sig in self.gui_signatures.items()
+            if sig.origin is not None
+        }
+        data = load_json_cache(self.GUI_SIGNATURE_CACHE)
+        data[str(list(self.gui_bbox))] = learned
+        save_json_cache(self.GUI_SIGNATURE_CACHE, data)
+
+    def detect_template_on_screen(self, template, threshold=GUI_TEMPLATE_THRESHOLD, bbox=None):
+        if template is None:
+            return False
+        try:
+            screenshot_cv = self.capture.region(*(bbox or self.gui_bbox))
+            return self._template_score(screenshot_cv, self._as_bgr(template)) >= threshold
+        except Exception as e:
+            print(f"Template detection error: {e}")
+            return False
+
+    @timed('screen.classify')
+    def classify_screen(self, bbox=None, img=None):
+        """Score every GUI template against one grab of bbox and return a ScreenState.
+
+        img is a grab of gui_bbox the caller already holds; it is scored instead of grabbing again.
+        """
+        scores = {}
+        try:
+            screenshot_cv = img if img is not None else self.capture.region(*(bbox or self.gui_bbox))
+            with self._gui_lock:
+                for name, template_bgr in self.gui_templates.items():
+                    if bbox is None:
+                        scores[name] = self._gui_score(name, screenshot_cv)
+                    else:
+                        scores[name] = self._template_score(screenshot_cv, template_bgr)
+        except Exception as e:
+            print(f"Screen classification error: {e}")
+        return ScreenState(scores)
+
+    def capture_region(self, x1, y1, x2, y2):
+        try:
+            return self.capture.region(x1, y1, x2, y2)
+        except Exception as e:
+            print(f"Capture error: {e}")
+            return None
+
+    def detect_paper_in_slot(self, slot_roi):
+        if self.paper_template is None or self.paper_template_gray is None or slot_roi.size == 0:
+            return False, 0.0
+        try:
+            template_h, template_w = self.paper_template.shape[:2]
+            if slot_roi.shape[0] < template_h * 0.5 or slot_roi.shape[1] < template_w * 0.5:
+                return False, 0.0
+            slot_gray = cv2.cvtColor(slot_roi, cv2.COLOR_BGR2GRAY)
+            key = slot_gray.shape[:2]
+            locked = self.paper_scale_lock.get(key)
+            if locked is not None:
+                confidence = self._paper_scale_score(slot_gray, locked)
+                if (confidence >= self.paper_match_threshold or
+                        confidence < self.paper_match_threshold - self.PAPER_LOCK_MARGIN):
+                    return confidence >= self.paper_match_threshold, confidence
+
+            max_confidence = 0.0
+            best_idx = None
+            for idx in range(len(self.paper_pyramid)):
+                confidence = self._paper_scale_score(slot_gray, idx)
+                if confidence > max_confidence:
+                    max_confidence = confidence
+                    best_idx = idx
+            is_paper = max_confidence >= self.paper_match_threshold
+            if is_paper:
+                self.paper_scale_lock[key] = best_idx
+            return is_paper, max_confidence
+        except Exception:
+            return False, 0.0
+
+    def _paper_scale_score(self, slot_gray, idx):
+        scaled_template = self.paper_pyramid[idx]
+        if (scaled_template.shape[1] > slot_gray.shape[1] or
+                scaled_template.shape[0] > slot_gray.shape[0]):
+            return 0.0
+        result = cv2.matchTemplate(slot_gray, scaled_template, cv2.TM_CCOEFF_NORMED)
+        _, max_val, _, _ = cv2.minMaxLoc(result)
+        return max_val
+
+    def region_box(self, region):
+        """Screen box (x1, y1, x2, y2) of the 'chest' / 'order' / 'backpack' slot grid."""
+        if region == 'backpack':
+            return self.bp_x1, self.bp_y1, self.bp_x2, self.bp_y2
+        if region == 'order':
+            return self.order_x1, self.order_y1, self.order_x2, self.order_y2
+        return self.x1, self.y1, self.x2, self.y2
+
+    @timed('slots.rects')
+    def find_slot_rects(self, img, region=None):
+        """Find inventory slot rectangles (sorted top-left, max 27).
+
+        With a region name the grid comes from the slot-geometry cache and is
+        only re-detected when the cached probes no longer match.
+        """
+        if region is not None:
+            cached = self.slot_geometry.get(region, img)
+            if cached is not None:
+                return cached
+        rects = self._detect_slot_rects(img)
+        if region is not None:
+            self.slot_geometry.store(region, img, rects)
+        return rects
+
+    def _detect_slot_rects(self, img):
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+        edges = cv2.Canny(blurred, 50, 150)
+        contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        slots = []
+        for contour in contours:
+            peri = cv2.arcLength(contour, True)
+            approx = cv2.approxPolyDP(contour, 0.04 * peri, True)
+            if len(approx) != 4:
+                continue
+            x, y, w, h = cv2.boundingRect(approx)
+            aspect_ratio = w / float(h)
+            if 0.7 < aspect_ratio < 1.3 and 10 < w < 150 and 10 < h < 150:
+                slots.append((x, y, w, h))
+        return sorted(slots, key=lambda s: (s[1], s[0]))
+
+    @timed('slots.paper')
+    def paper_results(self, img, rects):
+        """(is_paper, confidence) per rect, or None where the caller must match per slot.
+
+        Rects whose slot size has a locked paper scale read their peak from one
+        whole-image correlation per scale; TM_CCOEFF_NORMED is window-local,
+        so the peak inside a rect equals a per-slot matchTemplate.
+        """
+        results = [None] * len(rects)
+        if not self.batched_paper_matching or not self.paper_pyramid:
+            return results
+        img_h, img_w = img.shape[:2]
+        template_h, template_w = self.paper_template.shape[:2]
+        by_scale = {}
+        for i, (x, y, w, h) in enumerate(rects):
+            h = min(y + h, img_h) - y
+            w = min(x + w, img_w) - x
+            if h <= 0 or w <= 0:
+                continue
+            if h < template_h * 0.5 or w < template_w * 0.5:
+                results[i] = (False, 0.0)
+                continue
+            locked = self.paper_scale_lock.get((h, w))
+            if locked is not None:
+                by_scale.setdefault(locked, []).append((i, x, y, w, h))
+        if not by_scale:
+            return results
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        for idx, members in by_scale.items():
+            scaled_template = self.paper_pyramid[idx]
+            th, tw = scaled_template.shape[:2]
+            if th > img_h or tw > img_w:
+                continue
+            response = cv2.matchTemplate(gray, scaled_template, cv2.TM_CCOEFF_NORMED)
+            for i, x, y, w, h in members:
+                if th > h or tw > w:
+                    results[i] = (False, 0.0)
+                    continue
+                confidence = float(response[y:y + h - th + 1, x:x + w - tw + 1].max())
+                if confidence >= self.paper_match_threshold:
+                    results[i] = (True, confidence)
+                elif confidence < self.paper_match_threshold - self.PAPER_LOCK_MARGIN:
+                    results[i] = (False, confidence)
+        return results
+
+    def _measure_slot(self, slot_roi, paper=None):
+        """(has_paper, colour std, gray variance): everything both slot classifiers need."""
+        has_paper, _ = paper if paper is not None else self.detect_paper_in_slot(slot_roi)
+        gray_roi = cv2.cvtColor(slot_roi, cv2.COLOR_BGR2GRAY)
+        return has_paper, float(np.std(slot_roi)), float(np.var(gray_roi))
+
+    def _count_state(self, measure):
+        has_paper, std, _ = measure
+        if has_paper or std < self.threshold:
+            return "empty"
+        return "filled"
+
+    @staticmethod
+    def _is_click_target(measure):
+        has_paper, _, variance = measure
+        return not has_paper and variance > 1000
+
+    def classify_slot_for_count(self, slot_roi, paper=None):
+        return self._count_state(self._measure_slot(slot_roi, paper))
+
+    def is_filled_click_target(self, slot_roi, paper=None):
+        return self._is_click_target(self._measure_slot(slot_roi, paper))
+
+    @timed('slots.measure')
+    def slot_measures(self, img, region=None):
+        """[(rect, measure)] for up to 27 slots.
+
+        With a region name each slot keeps a fingerprint from the previous
+        call, and only slots whose fingerprint changed are measured again.
+        """
+        rects = self.find_slot_rects(img, region)[:27]
+        memo = self._slot_memo.get(region, {}) if region is not None else None
+        fingerprints = [None] * len(rects)
+        measures = [None] * len(rects)
+        stale = []
+        if memo is not None:
+            step = self.FINGERPRINT_STEP
+            small = cv2.resize(
+                img,
+                (max(1, img.shape[1] // step), max(1, img.shape[0] // step)),
+                interpolation=cv2.INTER_AREA,
+            ).astype(np.int16)
+        for i, rect in enumerate(rects):
+            if memo is not None:
+                x, y, w, h = rect
+                fingerprint = small[y // step:(y + h) // step, x // step:(x + w) // step]
+                fingerprints[i] = fingerprint
+                entry = memo.get(rect)
+                if (entry is not None and entry[0].shape == fingerprint.shape and
+                        (fingerprint.size == 0 or
+                         np.abs(fingerprint - entry[0]).max() <= self.FINGERPRINT_TOLERANCE)):
+                    measures[i] = entry[1]
+                    continue
+            stale.append(i)
+
+        papers = self.paper_results(img, [rects[i] for i in stale])
+        for i, paper in zip(stale, papers):
+            x, y, w, h = rects[i]
+            slot_roi = img[y:y + h, x:x + w]
+            if slot_roi.size == 0:
+                continue
+            measures[i] = self._measure_slot(slot_roi, paper)
+
+        if memo is not None:
+            self._slot_memo[region] = {
+                rect: (fingerprint, measure)
+                for rect, fingerprint, measure in zip(rects, fingerprints, measures)
+                if measure is not None
+            }
+        return [(rect, measure) for rect, measure in zip(rects, measures) if measure is not None]
+
+    def analyze_slots(self, img, region=None):
+        """Count empty/filled slots and return per-slot state for overlay drawing."""
+        if img is None:
+            return 0, 0, []
+        try:
+            empty_count = 0
+            filled_count = 0
+            analyzed = []
+            for (x, y, w, h), measure in self.slot_measures(img, region):
+                state = self._count_state(measure)
+                analyzed.append((x, y, w, h, state))
+                if state == "empty":
+                    empty_count += 1
+                else:
+                    filled_count += 1
+            return empty_count, filled_count, analyzed
+        except Exception as e:
+            print(f"analyze_slots error: {e}")
+            return 0, 0, []
+
+    def detect_slots(self, img, region=None):
+        empty_count, filled_count, _ = self.analyze_slots(img, region)
+        return empty_count, filled_count
+
+    def draw_slot_overlay(self, img, analyzed):
+        output = img.copy()
+        for x, y, w, h, state in analyzed:
+            color = (0, 255, 0) if state == "empty" else (0, 0, 255)
+            cv2.rectangle(output, (x, y), (x + w, y + h), color, 2)
+        return output
+
+    def get_empty_slot_count(self):
+        img = self.capture_region(self.x1, self.y1, self.x2, self.y2)
+        empty, _ = self.detect_slots(img, 'chest')
+        return empty
+
+    def _filled_clicks_from_image(self, img, region_x1, region_y1, region=None):
+        clicks = []
+        for (x, y, w, h), measure in self.slot_measures(img, region):
+            if self._is_click_target(measure):
+                clicks.append((region_x1 + x + w // 2, region_y1 + y + h // 2))
+        return clicks
+
+    def slot_filled_at(self, region, pos):
+        """Whether the region's slot under screen point pos still holds a click target; None if no slot is there."""
+        x1, y1, x2, y2 = self.region_box(region)
+        img = self.capture_region(x1, y1, x2, y2)
+        if img is None:
+            return None
+        px, py = pos[0] - x1, pos[1] - y1
+        for x, y, w, h in self.find_slot_rects(img, region):
+            if x <= px < x + w and y <= py < y + h:
+                return self.is_filled_click_target(img[y:y + h, x:x + w])
+        return None
+
+    def get_backpack_filled_clicks(self):
+        img = self.capture_region(self.bp_x1, self.bp_y1, self.bp_x2, self.bp_y2)
+        if img is None:
+            return []
+        try:
+            return self._filled_clicks_from_image(img, self.bp_x1, self.bp_y1, 'backpack')
+        except Exception as e:
+            print(f"get_backpack_filled_clicks error: {e}")
+            return []
+
+    def get_filled_clicks_in_region(self, x1, y1, x2, y2, region=None):
+        img = self.capture_region(x1, y1, x2, y2)
+        if img is None:
+            return []
+        try:
+            return self._filled_clicks_from_image(img, x1, y1, region)
+        except Exception as e:
+            print(f"get_filled_clicks_in_region error: {e}")
+            return []
+
+
+InputStep = collections.namedtuple('InputStep', 'action args after', defaults=((), 0.0))
+
+
+class InputBackend:
+    """Base for input backends: one method per INPUT_ACTIONS entry, none of which sleeps.
+
+    Pacing is the caller's: InputStep.after says how long the game needs
+    once an action is sent, and run() plays a batch of steps with those
+    delays and nothing else.
+    """
+
+    def run(self, steps):
+        for step in steps:
+            getattr(self, step.action)(*step.args)
+            if step.after:
+                pause(step.after)
+
+
+class PyAutoGuiInput(InputBackend):
+    """Default input backend: pyautogui for keys and clicks, pynput for the wheel, pyperclip for the clipboard."""
+
+    def __init__(self):
+        self._mouse = mouse.Controller()
+
+    @timed('input.press')
+    def press(self, key):
+        pyautogui.press(key)
+
+    @timed('input.hotkey')
+    def hotkey(self, *keys):
+        pyautogui.hotkey(*keys)
+
+    @timed('input.write')
+    def write(self, text, interval=0.0):
+        pyautogui.write(text, interval=interval)
+
+    @timed('input.click')
+    def click(self, x=None, y=None):
+        pyautogui.click(x, y)
+
+    @timed('input.move_to')
+    def move_to(self, x, y):
+        pyautogui.moveTo(x, y)
+
+    @timed('input.mouse_down')
+    def mouse_down(self):
+        pyautogui.mouseDown()
+
+    @timed('input.mouse_up')
+    def mouse_up(self):
+        pyautogui.mouseUp()
+
+    @timed('input.key_down')
+    def key_down(self, key):
+        pyautogui.keyDown(key)
+
+    @timed('input.key_up')
+    def key_up(self, key):
+        pyautogui.keyUp(key)
+
+    @timed('input.scroll')
+    def scroll(self, dy):
+        """Wheel notches with pynput's sign: -1 moves the hotbar selection right, 1 left."""
+        self._mouse.scroll(0, dy)
+
+    @timed('input.copy')
+    def copy(self, text):
+        pyperclip.copy(text)
+
+
+class DirectInput(InputBackend):
+    """Windows backend that calls user32 keybd_event / mouse_event / SetCursorPos itself.
+
+    Sends the same events as pyautogui without its per-call fail-safe check,
+    tweening and pause; keys carry scan codes as well as virtual-key codes.
+    """
+
+    KEY_CODES = {'enter': 0x0D, 'return': 0x0D, 'escape': 0x1B, 'esc': 0x1B, 'tab': 0x09,
+                 'backspace': 0x08, 'space': 0x20, 'shift': 0x10, 'ctrl': 0x11, 'alt': 0x12}
+    KEYEVENTF_KEYUP = 0x0002
+    MOUSEEVENTF_LEFTDOWN = 0x0002
+    MOUSEEVENTF_LEFTUP = 0x0004
+    MOUSEEVENTF_WHEEL = 0x0800
+    WHEEL_DELTA = 120
+
+    def __init__(self):
+        if _USER32 is None:
+            raise RuntimeError("the direct input backend needs Windows")
+
+    def _vk(self, key):
+        """(virtual-key code, needs shift) for a key name or a single character."""
+        if key in self.KEY_CODES:
+            return self.KEY_CODES[key], False
+        scan = _USER32.VkKeyScanW(ord(key)) & 0xFFFF
+        if scan == 0xFFFF:
+            raise ValueError(f"no key for {key!r}")
+        return scan & 0xFF, bool(scan & 0x100)
+
+    def _key(self, vk, up=False):
+        flags = self.KEYEVENTF_KEYUP if up else 0
+        _USER32.keybd_event(vk, _USER32.MapVirtualKeyW(vk, 0), flags, 0)
+
+    def _tap(self, key):
+        vk, shifted = self._vk(key)
+        if shifted:
+            self._key(self.KEY_CODES['shift'])
+        self._key(vk)
+        self._key(vk, up=True)
+        if shifted:
+            self._key(self.KEY_CODES['shift'], up=True)
+
+    @timed('input.press')
+    def press(self, key):
+        self._tap(key)
+
+    @timed('input.hotkey')
+    def hotkey(self, *keys):
+        codes = [self._vk(key)[0] for key in keys]
+        for vk in codes:
+            self._key(vk)
+        for vk in reversed(codes):
+            self._key(vk, up=True)
+
+    @timed('input.write')
+    def write(self, text, interval=0.0):
+        for ch in text:
+            self._tap(ch)
+            if interval:
+                time.sleep(interval)
+
+    @timed('input.click')
+    def click(self, x=None, y=None):
+        if x is not None:
+            _USER32.SetCursorPos(int(x), int(y))
+        _USER32.mouse_event(self.MOUSEEVENTF_LEFTDOWN, 0, 0, 0, 0)
+        _USER32.mouse_event(self.MOUSEEVENTF_LEFTUP, 0, 0, 0, 0)
+
+    @timed('input.move_to')
+    def move_to(self, x, y):
+        _USER32.SetCursorPos(int(x), int(y))
+
+    @timed('input.mouse_down')
+    def mouse_down(self):
+        _USER32.mouse_event(self.MOUSEEVENTF_LEFTDOWN, 0, 0, 0, 0)
+
+    @timed('input.mouse_up')
+    def mouse_up(self):
+        _USER32.mouse_event(self.MOUSEEVENTF_LEFTUP, 0, 0, 0, 0)
+
+    @timed('input.key_down')
+    def key_down(self, key):
+        self._key(self._vk(key)[0])
+
+    @timed('input.key_up')
+    def key_up(self, key):
+        self._key(self._vk(key)[0], up=True)
+
+    @timed('input.scroll')
+    def scroll(self, dy):
+        _USER32.mouse_event(self.MOUSEEVENTF_WHEEL, 0, 0, ctypes.c_uint32(dy * self.WHEEL_DELTA).value, 0)
+
+    @timed('input.copy')
+    def copy(self, text):
+        pyperclip.copy(text)
+
+
+class XTestInput(InputBackend):
+    """X11 backend through the XTest extension (python-xlib), e.g. for a client running under Xvfb.
+
+    Uses $DISPLAY unless display is given. Wheel notches are buttons 4 (up)
+    and 5 (down), matching pynput's sign.
+    """
+
+    KEYSYMS = {'enter': 'Return', 'return': 'Return', 'escape': 'Escape', 'esc': 'Escape', 'tab': 'Tab',
+               'backspace': 'BackSpace', 'space': 'space', 'shift': 'Shift_L', 'ctrl': 'Control_L',
+               'alt': 'Alt_L', '/': 'slash', ' ': 'space', '.': 'period', '-': 'minus'}
+
+    def __init__(self, display=None):
+        try:
+            from Xlib import X, XK, display as xdisplay
+            from Xlib.ext import xtest
+        except ImportError as e:
+            raise RuntimeError("the xtest input backend needs python-xlib (pip install python-xlib)") from e
+        self._X = X
+        self._XK = XK
+        self._xtest = xtest
+        self._display = xdisplay.Display(display)
+        if not self._display.has_extension('XTEST'):
+            raise RuntimeError("the X server has no XTEST extension")
+
+    def _keycode(self, key):
+        """(keycode, needs shift) for a key name or a single character."""
+        keysym = self._XK.string_to_keysym(self.KEYSYMS.get(key, key))
+        codes = list(self._display.keysym_to_keycodes(keysym)) if keysym else []
+        if not codes:
+            raise ValueError(f"no key for {key!r}")
+        keycode, index = codes[0]
+        return keycode, index % 2 == 1
+
+    def _key(self, keycode, up=False):
+        self._xtest.fake_input(self._display, self._X.KeyRelease if up else self._X.KeyPress, keycode)
+
+    def _tap(self, key):
+        keycode, shifted = self._keycode(key)
+        shift = self._keycode('shift')[0]
+        if shifted:
+            self._key(shift)
+        self._key(keycode)
+        self._key(keycode, up=True)
+        if shifted:
+            self._key(shift, up=True)
+        self._display.sync()
+
+    def _button(self, button):
+        self._xtest.fake_input(self._display, self._X.ButtonPress, button)
+        self._xtest.fake_input(self._display, self._X.ButtonRelease, button)
+
+    @timed('input.press')
+    def press(self, key):
+        self._tap(key)
+
+    @timed('input.hotkey')
+    def hotkey(self, *keys):
+        codes = [self._keycode(key)[0] for key in keys]
+        for keycode in codes:
+            self._key(keycode)
+        for keycode in reversed(codes):
+            self._key(keycode, up=True)
+        self._display.sync()
+
+    @timed('input.write')
+    def write(self, text, interval=0.0):
+        for ch in text:
+            self._tap(ch)
+            if interval:
+                time.sleep(interval)
+
+    @timed('input.click')
+    def click(self, x=None, y=None):
+        if x is not None:
+            self._xtest.fake_input(self._display, self._X.MotionNotify, x=int(x), y=int(y))
+        self._button(1)
+        self._display.sync()
+
+    @timed('input.move_to')
+    def move_to(self, x, y):
+        self._xtest.fake_input(self._display, self._X.MotionNotify, x=int(x), y=int(y))
+        self._display.sync()
+
+    @timed('input.mouse_down')
+    def mouse_down(self):
+        self._xtest.fake_input(self._display, self._X.ButtonPress, 1)
+        self._display.sync()
+
+    @timed('input.mouse_up')
+    def mouse_up(self):
+        self._xtest.fake_input(self._display, self._X.ButtonRelease, 1)
+        self._display.sync()
+
+    @timed('input.key_down')
+    def key_down(self, key):
+        self._key(self._keycode(key)[0])
+        self._display.sync()
+
+    @timed('input.key_up')
+    def key_up(self, key):
+        self._key(self._keycode(key)[0], up=True)
+        self._display.sync()
+
+    @timed('input.scroll')
+    def scroll(self, dy):
+        for _ in range(abs(dy)):
+            self._button(4 if dy > 0 else 5)
+        self._display.sync()
+
+    @timed('input.copy')
+    def copy(self, text):
+        pyperclip.copy(text)
+
+
+class FakeInput(InputBackend):
+    """Input backend that performs nothing and keeps (time, action, args, kwargs) tuples, for replays and tests."""
+
+    def __init__(self):
+        self.actions = []
+
+    def __getattr__(self, name):
+        if name not in INPUT_ACTIONS:
+            raise AttributeError(name)
+
+        def record(*args, **kwargs):
+            self.actions.append((time.monotonic(), name, args, kwargs))
+        return record
+
+
+class RecordingInput(InputBackend):
+    """Forwards every action to another backend and logs it to a SessionRecorder first."""
+
+    def __init__(self, inner, recorder):
+        self.inner = inner
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        target = getattr(self.inner, name)
+        if name not in INPUT_ACTIONS:
+            return target
+
+        def forward(*args, **kwargs):
+            self.recorder.input(name, args, kwargs)
+            return target(*args, **kwargs)
+        return forward
+
+
+# Backends selectable with --input.
+INPUT_BACKENDS = {'pyautogui': PyAutoGuiInput, 'direct': DirectInput, 'xtest': XTestInput, 'fake': FakeInput}
+
+
+class SessionRecorder:
+    """Records one automation run into a session zip for offline replay.
+
+    Every screen read made by the recording thread is kept as a PNG crop
+    (encoded on a background thread so the run is not slowed down), and
+    inputs and status updates are kept as timestamped events. Reads of the
+    same frame and box are stored once.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path, meta=None):
+        self.path = path
+        self.meta = dict(meta or {})
+        self.events = []
+        self.thread = threading.current_thread()
+        self.started = time.monotonic()
+        self._crop_ids = {}
+        self._pngs = {}
+        self._queue = queue.Queue()
+        self._encoder = threading.Thread(target=self._encode_loop, name="session-encoder", daemon=True)
+        self._encoder.start()
+
+    def _elapsed(self):
+        return round(time.monotonic() - self.started, 4)
+
+    def _encode_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            crop_id, img = item
+            ok, buf = cv2.imencode('.png', img, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+            if ok:
+                self._pngs[crop_id] = buf.tobytes()
+
+    def frame_read(self, seq, bbox, img):
+        """Log a region read; seq is the shared frame number, None for one-off grabs."""
+        if threading.current_thread() is not self.thread:
+            return
+        bbox = [int(v) for v in bbox]
+        key = (seq, tuple(bbox)) if seq is not None else None
+        crop_id = self._crop_ids.get(key) if key is not None else None
+        if crop_id is None:
+            crop_id = len(self._crop_ids) if key is not None else f"g{len(self.events)}"
+            if key is not None:
+                self._crop_ids[key] = crop_id
+            self._queue.put((crop_id, img))
+        self.events.append({'t': self._elapsed(), 'kind': 'frame', 'bbox': bbox, 'crop': str(crop_id)})
+
+    def input(self, action, args, kwargs):
+        self.events.append({
+            't': self._elapsed(), 'kind': 'input', 'action': action,
+            'args': list(args), 'kwargs': dict(kwargs),
+        })
+
+    def status(self, message, progress):
+        self.events.append({'t': self._elapsed(), 'kind': 'status', 'message': message, 'progress': progress})
+
+    def save(self):
+        self._queue.put(None)
+        self._encoder.join()
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        session = dict(self.meta, version=self.VERSION, duration=self._elapsed(), events=self.events)
+        with zipfile.ZipFile(self.path, 'w', zipfile.ZIP_STORED) as zf:
+            zf.writestr('session.json', json.dumps(session, default=lambda v: v.item() if hasattr(v, 'item') else str(v)))
+            for crop_id, png in self._pngs.items():
+                zf.writestr(f'frames/{crop_id}.png', png)
+        return self.path
+
+
+class RecordedSession:
+    """A session zip written by SessionRecorder, with its crops decoded to BGR."""
+
+    def __init__(self, path):
+        self.path = path
+        with zipfile.ZipFile(path) as zf:
+            data = json.loads(zf.read('session.json'))
+            self.crops = {}
+            for name in zf.namelist():
+                if name.startswith('frames/') and name.endswith('.png'):
+                    buf = np.frombuffer(zf.read(name), np.uint8)
+                    img = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+                    img.flags.writeable = False
+                    self.crops[name[len('frames/'):-len('.png')]] = img
+        self.meta = {k: v for k, v in data.items() if k != 'events'}
+        self.events = data.get('events', [])
+        self.frames = [e for e in self.events if e['kind'] == 'frame']
+        self.inputs = [e for e in self.events if e['kind'] == 'input']
+        self.statuses = [e for e in self.events if e['kind'] == 'status']
+
+    def layout(self):
+        layout = self.meta.get('layout')
+        if not layout:
+            return LayoutProfile()
+        return LayoutProfile(layout.get('gui_scale', REFERENCE_GUI_SCALE), layout.get('anchors'), layout.get('client'))
+
+
+class SessionReplayCapture(ScreenCapture):
+    """ScreenCapture that answers region reads from a RecordedSession.
+
+    'sequence' mode hands back the recorded crops in read order, which replays
+    unchanged code exactly; a read for a different box marks the replay as
+    diverged and falls back to the timeline. 'timeline' mode returns the last
+    crop of the same box recorded at or before the elapsed replay time, so
+    changed code still sees a plausible screen.
+    """
+
+    def __init__(self, session, mode='sequence'):
+        super().__init__(threaded=False)
+        self.session = session
+        self.mode = mode
+        self.position = 0
+        self.diverged = None
+        self.started = time.monotonic()
+        self._by_bbox = {}
+        for event in session.frames:
+            self._by_bbox.setdefault(tuple(event['bbox']), []).append(event)
+
+    def latest(self, max_age=None, timeout=0.5):
+        return None
+
+    def _timeline_crop(self, bbox):
+        events = self._by_bbox.get(bbox)
+        if not events:
+            raise ValueError(f"no recorded frames for box {bbox}")
+        elapsed = time.monotonic() - self.started
+        pick = events[0]
+        for event in events:
+            if event['t'] > elapsed:
+                break
+            pick = event
+        return self.session.crops[pick['crop']]
+
+    def region(self, x1, y1, x2, y2, max_age=None):
+        bbox = (x1, y1, x2, y2)
+        if self.mode == 'sequence' and self.diverged is None:
+            if self.position < len(self.session.frames):
+                event = self.session.frames[self.position]
+                if tuple(event['bbox']) == bbox:
+                    self.position += 1
+                    return self.session.crops[event['crop']]
+            self.diverged = self.position
+            print(f"Replay diverged at read {self.position}: {bbox}")
+        return self._timeline_crop(bbox)
+
+    def grab_once(self, x1, y1, x2, y2):
+        return self.region(x1, y1, x2, y2)
+
+
+class GameSimulator(InputBackend):
+    """Offline stand-in for the game, for headless end-to-end runs of run_automation.
+
+    Renders the hotbar and the AH / order / backpack containers from an
+    in-memory inventory (GUI icons and paper come from the embedded sprites,
+    so the real detectors run unchanged) and acts as the input backend.
+    Every state change lands after a per-kind latency, and a share of inputs
+    can be dropped to exercise the retry paths. Each input takes input_pause
+    of wall time on top of any typing interval.
+    """
+
+    LATENCY = {'command': 0.35, 'gui': 0.25, 'transfer': 0.05, 'select': 0.03, 'sell': 0.15}
+    DOUBLE_CLICK_WINDOW = 0.25
+    # Screen each container falls back to on 'e'.
+    PARENT = {'chest': 'ah_menu', 'ah_menu': 'world', 'order_menu': 'world', 'order_list': 'world',
+              'order': 'world', 'backpack': 'world', 'sell_confirm': 'world'}
+    # Where the GUI icon sits, as a fraction of the GUI box (kept clear of the grid shown on that screen).
+    ICON_SPOTS = {'chest': (0.82, 0.8), 'order': (0.82, 0.8), 'backpack': (0.82, 0.04)}
+
+    def __init__(self, layout=None, hotbar=0, backpack=27, listings=0, order_stock=200,
+                 latency=None, drop_rate=0.0, input_pause=0.0, seed=0):
+        self.layout = layout or LayoutProfile()
+        self.latency = dict(self.LATENCY, **(latency or {}))
+        self.drop_rate = drop_rate
+        self.input_pause = input_pause
+        self.rng = np.random.default_rng(seed)
+        self.hotbar = [i < hotbar for i in range(9)]
+        self.backpack = [i < backpack for i in range(27)]
+        self.listings = [i < listings for i in range(27)]
+        self.order_stock = order_stock
+        self.order_slots = [False] * 27
+        self.order_option = None
+        self.selected = 0
+        self.screen = 'world'
+        self.chat = None
+        self.clipboard = ''
+        self.shift = False
+        self.mouse_pos = (0, 0)
+        self.button_down = False
+        # (time, screen, slot) of the last shift-click, to spot a double-click.
+        self._last_shift_click = None
+        self.version = 0
+        self.pending = []
+        self.stats = {'inputs': 0, 'clicks': 0, 'wasted_clicks': 0, 'dropped_inputs': 0,
+                      'commands': 0, 'failed_sells': 0, 'transfers': 0, 'listed': 0}
+        self._sprites = {}
+        self._background = None
+        self._icons = None
+        self._paper = None
+
+    # --- inventory model ---
+    def _later(self, kind, apply):
+        self.pending.append((time.monotonic() + self.latency[kind], apply))
+
+    def settle(self):
+        """Apply every state change whose latency has elapsed."""
+        now = time.monotonic()
+        due = [p for p in self.pending if p[0] <= now]
+        if not due:
+            return
+        self.pending = [p for p in self.pending if p[0] > now]
+        for _, apply in sorted(due, key=lambda p: p[0]):
+            apply()
+        self.version += 1
+
+    def _set_screen(self, screen):
+        def apply():
+            self.screen = screen
+            if screen == 'order':
+                self.order_slots = [i < self.order_stock for i in range(27)]
+        return apply
+
+    def _run_command(self, text):
+        self.stats['commands'] += 1
+        if text == '/ah':
+            self._later('command', self._set_screen('ah_menu'))
+        elif text == '/order':
+            self._later('command', self._set_screen('order_menu'))
+        elif text.startswith('/ah sell'):
+            if self.hotbar[self.selected] and not all(self.listings):
+                self._later('command', self._set_screen('sell_confirm'))
+            else:
+                self.stats['failed_sells'] += 1
+
+    def _confirm_sale(self):
+        if self.screen != 'sell_confirm':
+            return
+        self.screen = 'world'
+        if self.hotbar[self.selected] and not all(self.listings):
+            self.hotbar[self.selected] = False
+            self.listings[self.listings.index(False)] = True
+            self.stats['listed'] += 1
+
+    def _slot_at(self, region, pos):
+        x1, y1, x2, y2 = self.layout.box(region)
+        pitch = (x2 - x1) // 9
+        col, row = (pos[0] - x1) // pitch, (pos[1] - y1 - 1) // pitch
+        if 0 <= col < 9 and 0 <= row < 3:
+            return row * 9 + col
+        return None
+
+    def _near(self, pos, name):
+        x, y = self.layout.click(name)
+        reach = self.layout.factor * 36
+        return abs(pos[0] - x) <= reach and abs(pos[1] - y) <= reach
+
+    def _move_to_player(self, source, index):
+        """Shift-click: item goes to the first free hotbar slot, else the backpack."""
+        def apply():
+            if not source[index]:
+                return
+            if source is self.backpack or False in self.hotbar:
+                target = self.hotbar
+            else:
+                target = self.backpack
+            if False not in target:
+                return
+            source[index] = False
+            target[target.index(False)] = True
+            if source is self.order_slots:
+                self.order_stock -= 1
+            self.stats['transfers'] += 1
+        self._later('transfer', apply)
+
+    def _click(self, pos):
+        self.stats['clicks'] += 1
+        screen = self.screen
+        if screen == 'ah_menu' and self._near(pos, 'menu_button'):
+            self._later('gui', self._set_screen('chest'))
+        elif screen == 'order_menu' and self._near(pos, 'menu_button'):
+            self._later('gui', self._set_screen('order_list'))
+        elif screen == 'order_list' and self._near(pos, 'order_confirm') and self.order_option:
+            self._later('gui', self._set_screen('order'))
+        elif screen == 'order_list' and any(self._near(pos, f'order_option_{n}') for n in range(1, 5)):
+            self.order_option = next(n for n in range(1, 5) if self._near(pos, f'order_option_{n}'))
+        elif screen == 'sell_confirm' and self._near(pos, 'sell_confirm'):
+            self._later('sell', self._confirm_sale)
+        elif screen in ('backpack', 'order') and self.shift:
+            source = self.backpack if screen == 'backpack' else self.order_slots
+            index = self._slot_at(screen, pos)
+            now = time.monotonic()
+            last, self._last_shift_click = self._last_shift_click, (now, screen, index)
+            if (index is not None and last is not None and last[1:] == (screen, index)
+                    and now - last[0] <= self.DOUBLE_CLICK_WINDOW):
+                # Shift+double-click: every stack of the same item moves (all items here are one kind).
+                for i, filled in enumerate(source):
+                    if filled:
+                        self._move_to_player(source, i)
+            elif index is None or not source[index]:
+                self.stats['wasted_clicks'] += 1
+            else:
+                self._move_to_player(source, index)
+        else:
+            self.stats['wasted_clicks'] += 1
+
+    def _drag_over(self, pos):
+        """Shift-drag with the button held: every filled slot the pointer reaches moves to the player."""
+        if self.screen not in ('backpack', 'order') or not self.shift:
+            return
+        source = self.backpack if self.screen == 'backpack' else self.order_slots
+        index = self._slot_at(self.screen, pos)
+        if index is not None and source[index]:
+            self._move_to_player(source, index)
+
+    # --- input backend ---
+    def _input(self, duration=0.0):
+        """Count one input, spend its wall time; False if this one is dropped."""
+        self.settle()
+        self.stats['inputs'] += 1
+        if duration + self.input_pause > 0:
+            time.sleep(duration + self.input_pause)
+        self.settle()
+        if self.drop_rate and self.rng.random() < self.drop_rate:
+            self.stats['dropped_inputs'] += 1
+            return False
+        return True
+
+    def press(self, key):
+        if not self._input():
+            return
+        if self.chat is not None:
+            if key == 'enter':
+                text, self.chat = self.chat, None
+                self._run_command(text)
+            elif key == 'escape':
+                self.chat = None
+            return
+        if key == 'escape':
+            if self.screen != 'world':
+                self._later('gui', self._set_screen('world'))
+            return
+        if self.screen == 'world':
+            if key == 't':
+                self.chat = ''
+            elif key == 'e':
+                self._later('gui', self._set_screen('backpack'))
+            elif key in '123456789' and len(key) == 1:
+                self._later('select', lambda: setattr(self, 'selected', int(key) - 1))
+        elif key == 'e':
+            self._later('gui', self._set_screen(self.PARENT.get(self.screen, 'world')))
+
+    def hotkey(self, *keys):
+        if self._input() and self.chat is not None and keys == ('ctrl', 'v'):
+            self.chat += self.clipboard
+
+    def write(self, text, interval=0.0):
+        if self._input(interval * len(text)) and self.chat is not None:
+            self.chat += text
+
+    def click(self, x=None, y=None):
+        pos = (x, y) if x is not None else self.mouse_pos
+        self.mouse_pos = pos
+        if self._input():
+            self._click(pos)
+
+    def move_to(self, x, y):
+        self.mouse_pos = (x, y)
+        if self._input() and self.button_down:
+            self._drag_over((x, y))
+
+    def mouse_down(self):
+        if self._input():
+            self.button_down = True
+            self._drag_over(self.mouse_pos)
+
+    def mouse_up(self):
+        self.button_down = False
+        self._input()
+
+    def key_down(self, key):
+        if self._input() and key == 'shift':
+            self.shift = True
+
+    def key_up(self, key):
+        if key == 'shift':
+            self.shift = False
+        self._input()
+
+    def scroll(self, dy):
+        if self._input() and self.screen == 'world' and self.chat is None:
+            self._later('select', lambda: setattr(self, 'selected', (self.selected - dy) % 9))
+
+    def copy(self, text):
+        self.clipboard = text
+
+    # --- rendering ---
+    def _item_sprite(self, key, texel):
+        """Round item icon (16×16 texels, two-tone noise) that reads as a filled slot."""
+        sprite = self._sprites.get((key, texel))
+        if sprite is None:
+            rng = np.random.default_rng([ord(c) for c in repr(key)])
+            mask = np.zeros((16, 16), np.uint8)
+            cv2.circle(mask, (8, 8), 6, 1, -1)
+            dark, light = rng.integers(20, 80, 3), rng.integers(170, 240, 3)
+            texels = np.where(rng.random((16, 16, 1)) < 0.5, dark, light).astype(np.uint8)
+            size = (16 * texel, 16 * texel)
+            sprite = (cv2.resize(texels, size, interpolation=cv2.INTER_NEAREST),
+                      cv2.resize(mask, size, interpolation=cv2.INTER_NEAREST).astype(bool))
+            self._sprites[(key, texel)] = sprite
+        return sprite
+
+    def _paste_item(self, img, x, y, size, key, texel):
+        sprite, mask = self._item_sprite(key, texel)
+        h, w = mask.shape
+        off = (size - h) // 2
+        roi = img[y + off:y + off + h, x + off:x + off + w]
+        roi[mask] = sprite[mask]
+
+    def _load_art(self):
+        icons = {}
+        for name, b64 in (('chest', BOOK_PNG_B64), ('backpack', HIJAU_PNG_B64), ('order', ORDER_PNG_B64)):
+            icon = InventoryDetector._as_bgr(imdecode_from_base64(b64))
+            if self.layout.factor != 1.0:
+                icon = cv2.resize(icon, None, fx=self.layout.factor, fy=self.layout.factor,
+                                  interpolation=cv2.INTER_NEAREST)
+            icons[name] = icon
+        self._icons = icons
+        self._paper = InventoryDetector._as_bgr(imdecode_from_base64(PAPER_PNG_B64))
+
+    def _draw_grid(self, img, origin, region, filled, empty_paper=False):
+        ox, oy = origin
+        x1, y1, x2, y2 = self.layout.box(region)
+        pitch = (x2 - x1) // 9
+        texel = max(1, pitch // 18)
+        size = pitch - texel
+        paper = None
+        if empty_paper:
+            scale = (size - 2 * texel) / self._paper.shape[0] * 0.9
+            paper = cv2.resize(self._paper, None, fx=scale, fy=scale)
+        for i in range(27):
+            x = x1 - ox + texel // 2 + (i % 9) * pitch
+            y = y1 - oy + 1 + texel // 2 + (i // 9) * pitch
+            img[y:y + size, x:x + size] = 139
+            img[y:y + texel, x:x + size - texel] = 110
+            img[y:y + size - texel, x:x + texel] = 110
+            img[y + size - texel:y + size, x + texel:x + size] = 170
+            img[y + texel:y + size, x + size - texel:x + size] = 170
+            if filled[i]:
+                self._paste_item(img, x, y, size, (region, i), texel)
+            elif paper is not None:
+                off_y, off_x = (size - paper.shape[0]) // 2, (size - paper.shape[1]) // 2
+                img[y + off_y:y + off_y + paper.shape[0], x + off_x:x + off_x + paper.shape[1]] = paper
+
+    def _draw_hotbar(self, img, origin):
+        ox, oy = origin
+        x1, y1, x2, y2 = self.layout.box('hotbar')
+        pitch = (x2 - x1) / 9
+        height = y2 - y1
+        texel = max(1, height // 22)
+        for i in range(9):
+            x, xe = x1 - ox + int(i * pitch), x1 - ox + int((i + 1) * pitch)
+            y, ye = y1 - oy, y2 - oy
+            img[y:ye, x:xe] = 139
+            frame = 230 if i == self.selected else 55
+            img[y:y + texel, x:xe] = frame
+            img[ye - texel:ye, x:xe] = frame
+            img[y:ye, x:x + texel] = frame
+            img[y:ye, xe - texel:xe] = frame
+            if self.hotbar[i]:
+                self._paste_item(img, x + (xe - x - height) // 2, y, height, ('hotbar', i), texel)
+
+    def render(self):
+        """Full capture-box frame (BGR) of the current screen."""
+        if self._icons is None:
+            self._load_art()
+        left, top, right, bottom = self.layout.capture_bbox()
+        if self._background is None:
+            rng = np.random.default_rng(0)
+            self._background = rng.integers(30, 70, (bottom - top, right - left, 3)).astype(np.uint8)
+        img = self._background.copy()
+        if self.screen != 'world':
+            gx1, gy1, gx2, gy2 = self.layout.box('gui')
+            img[gy1 - top:gy2 - top, gx1 - left:gx2 - left] = 198
+            if self.screen in ('chest', 'order', 'backpack'):
+                bx1, by1, bx2, by2 = self.layout.box(self.screen)
+                img[by1 - top:by2 - top, bx1 - left:bx2 - left] = 198
+            if self.screen == 'chest':
+                self._draw_grid(img, (left, top), 'chest', self.listings, empty_paper=True)
+            elif self.screen == 'order':
+                self._draw_grid(img, (left, top), 'order', self.order_slots)
+            elif self.screen == 'backpack':
+                self._draw_grid(img, (left, top), 'backpack', self.backpack)
+            icon = self._icons.get(self.screen)
+            if icon is not None:
+                fx, fy = self.ICON_SPOTS[self.screen]
+                x = gx1 - left + int((gx2 - gx1) * fx)
+                y = gy1 - top + int((gy2 - gy1) * fy)
+                img[y:y + icon.shape[0], x:x + icon.shape[1]] = icon
+        self._draw_hotbar(img, (left, top))
+        return img
+
+    def report(self, elapsed):
+        stats = dict(self.stats, elapsed=round(elapsed, 2))
+        stats['listed_per_minute'] = round(60 * stats['listed'] / elapsed, 2) if elapsed > 0 else 0.0
+        return stats
+
+
+class SimulatedCapture(ScreenCapture):
+    """ScreenCapture whose reads all see a GameSimulator's current screen."""
+
+    def __init__(self, game):
+        super().__init__(bbox=game.layout.capture_bbox(), threaded=False)
+        self.game = game
+        self._version = None
+
+    def latest(self, max_age=None, timeout=0.5):
+        self.game.settle()
+        if self._frame is None or self._version != self.game.version:
+            self._version = self.game.version
+            left, top = self.game.layout.capture_bbox()[:2]
+            self._publish(self.game.render(), left, top)
+        return self._frame
+
+    def grab_once(self, x1, y1, x2, y2):
+        frame = self.latest()
+        if not frame.contains(x1, y1, x2, y2):
+            raise ValueError(f"bbox {(x1, y1, x2, y2)} is outside the simulated screen")
+        return frame.view(x1, y1, x2, y2)
+
+
+class DetectorBenchmark:
+    """Times the detectors on labelled golden frames and checks every answer.
+
+    Golden frames are GameSimulator scenes plus an optional frames_dir of
+    real captures described by a frames.json ([{"file", "left", "top",
+    "labels"}], labels as in _scene_labels). The detectors were tuned on
+    the simulator's renders, so those scenes mostly serve the timings; the
+    accuracy that counts comes from the frames_dir captures. A misread
+    slot fails the run: a faster detector that triggers retries is a net
+    loss. analyze_slots is timed cold (slot memo and geometry cache
+    cleared before every call) and, as analyze_slots_warm, on a repeat of
+    the frame it just analyzed.
+    """
+
+    CONTAINERS = ('chest', 'backpack', 'order')
+
+    def __init__(self, scenes=16, rounds=5, seed=0, frames_dir=None):
+        self.scenes = scenes
+        self.rounds = rounds
+        self.seed = seed
+        self.frames_dir = frames_dir
+        self.layout = LayoutProfile()
+
+    @staticmethod
+    def _scene_labels(game):
+        slots = {
+            'chest': ['item' if v else 'paper' for v in game.listings],
+            'backpack': ['item' if v else 'empty' for v in game.backpack],
+            'order': ['item' if v else 'empty' for v in game.order_slots],
+        }
+        return {
+            'selected': game.selected,
+            'hotbar': list(game.hotbar),
+            'gui': game.screen if game.screen in slots else None,
+            'slots': slots.get(game.screen),
+        }
+
+    def golden_frames(self):
+        """[(image, left, top, labels)]: simulator scenes first, then frames_dir captures."""
+        rng = np.random.default_rng(self.seed)
+        game = GameSimulator(layout=self.layout)
+        left, top = self.layout.capture_bbox()[:2]
+        screens = ('world',) + self.CONTAINERS
+        frames = []
+        for i in range(self.scenes):
+            game.screen = screens[i % len(screens)]
+            game.selected = int(rng.integers(9))
+            game.hotbar = (rng.random(9) < 0.5).tolist()
+            game.listings = (rng.random(27) < 0.5).tolist()
+            game.backpack = (rng.random(27) < 0.5).tolist()
+            game.order_slots = (rng.random(27) < 0.5).tolist()
+            frames.append((game.render(), left, top, self._scene_labels(game)))
+        if self.frames_dir:
+            with open(os.path.join(self.frames_dir, 'frames.json'), 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            for entry in entries:
+                img = cv2.imread(os.path.join(self.frames_dir, entry['file']), cv2.IMREAD_COLOR)
+                frames.append((img, entry['left'], entry['top'], entry['labels']))
+        return frames
+
+    @staticmethod
+    def _crop(frame, box):
+        img, left, top, _ = frame
+        x1, y1, x2, y2 = box
+        return img[y1 - top:y2 - top, x1 - left:x2 - left]
+
+    def _cases(self, frames):
+        """{case: [(call, check, prepare)]}: call runs the detector once, check(result) is its accuracy.
+
+        prepare (or None) sets up the call, e.g. publishes the frame it reads; it is not timed.
+        """
+        capture = ScreenCapture(threaded=False)
+        hotbar = HotbarDetector(capture)
+        detector = InventoryDetector(capture)
+        hotbar.apply_layout(self.layout)
+        detector.apply_layout(self.layout)
+        cases = {name: [] for name in ('find_selected_slot', 'analyze_all_slots', 'find_slot_rects',
+                                      'analyze_slots', 'analyze_slots_warm', 'detect_paper_in_slot',
+                                      'detect_template_on_screen')}
+
+        def forget_slots():
+            detector._slot_memo.clear()
+            detector.slot_geometry.clear()
+
+        for frame in frames:
+            labels = frame[3]
+            strip = self._crop(frame, self.layout.box('hotbar'))
+            cases['find_selected_slot'].append((
+                lambda strip=strip: hotbar.find_selected_slot(strip),
+                lambda got, want=labels['selected']: got == want,
+                None,
+            ))
+            cases['analyze_all_slots'].append((
+                lambda strip=strip: hotbar.analyze_all_slots(strip),
+                lambda got, want=labels['hotbar']: [b for b, _ in got] == want,
+                None,
+            ))
+
+            gui_img = self._crop(frame, self.layout.box('gui'))
+            for name, template in detector.gui_templates.items():
+                cases['detect_template_on_screen'].append((
+                    lambda template=template: detector.detect_template_on_screen(template),
+                    lambda got, want=(labels['gui'] == name): got == want,
+                    lambda gui_img=gui_img: capture._publish(gui_img, *self.layout.box('gui')[:2]),
+                ))
+
+            region = labels['gui']
+            if region not in self.CONTAINERS or not labels.get('slots'):
+                continue
+            grid = np.ascontiguousarray(self._crop(frame, self.layout.box(region)))
+            states = labels['slots']
+            cases['find_slot_rects'].append((
+                lambda grid=grid: detector.find_slot_rects(grid),
+                lambda got: len(got) == 27,
+                None,
+            ))
+            want_counts = (sum(s != 'item' for s in states), sum(s == 'item' for s in states))
+            analyze = lambda grid=grid, region=region: detector.analyze_slots(grid, region)
+            check = lambda got, want=want_counts: got[:2] == want
+            cases['analyze_slots'].append((analyze, check, forget_slots))
+            cases['analyze_slots_warm'].append((analyze, check, analyze))
+            for (x, y, w, h), state in zip(detector.find_slot_rects(grid)[:27], states):
+                roi = grid[y:y + h, x:x + w]
+                cases['detect_paper_in_slot'].append((
+                    lambda roi=roi: detector.detect_paper_in_slot(roi),
+                    lambda got, want=(state == 'paper'): got[0] == want,
+                    None,
+                ))
+        return cases
+
+    def run(self):
+        """{case: {'calls', 'ns_per_call', 'peak_alloc_kib', 'errors'}} over all golden frames."""
+        global USER_CACHES
+        user_caches, USER_CACHES = USER_CACHES, False
+        try:
+            return self._run()
+        finally:
+            USER_CACHES = user_caches
+
+    def _run(self):
+        results = {}
+        for name, calls in self._cases(self.golden_frames()).items():
+            if not calls:
+                continue
+            errors = 0
+            for call, check, prepare in calls:
+                if prepare is not None:
+                    prepare()
+                errors += not check(call())
+            tracemalloc.start()
+            for call, _, prepare in calls:
+                if prepare is not None:
+                    prepare()
+                call()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            timings = []
+            for _ in range(self.rounds):
+                elapsed = 0
+                for call, _, prepare in calls:
+                    if prepare is not None:
+                        prepare()
+                    started = time.perf_counter_ns()
+                    call()
+                    elapsed += time.perf_counter_ns() - started
+                timings.append(elapsed / len(calls))
+            results[name] = {
+                'calls': len(calls),
+                'ns_per_call': int(np.median(timings)),
+                'peak_alloc_kib': round(peak / 1024, 1),
+                'errors': errors,
+            }
+        return results
+
+    @staticmethod
+    def format(results, baseline=None):
+        lines = [f"{'case':<26}{'calls':>6}{'ns/call':>12}{'peak KiB':>10}{'errors':>8}"]
+        for name, r in results.items():
+            line = f"{name:<26}{r['calls']:>6}{r['ns_per_call']:>12}{r['peak_alloc_kib']:>10}{r['errors']:>8}"
+            before = (baseline or {}).get(name)
+            if before and before['ns_per_call']:
+                line += f"  {100 * (r['ns_per_call'] / before['ns_per_call'] - 1):+.1f}%"
+            lines.append(line)
+        return "\n".join(lines)
+
 
-    def detect_template_on_screen(self, template, threshold=0.8, bbox=(600, 250, 1300, 760)):
-        if template is None:
-            return False
-        try:
-            screenshot = ImageGrab.grab(bbox=bbox)
-            screenshot_np = np.array(screenshot)
-            screenshot_cv = cv2.cvtColor(screenshot_np, cv2.COLOR_RGB2BGR)
-            if len(template.shape) == 3 and template.shape[2] == 4:
-                template_bgr = cv2.cvtColor(template, cv2.COLOR_BGRA2BGR)
-            else:
-                template_bgr = template
-            if (template_bgr.shape[0] > screenshot_cv.shape[0] or
-                    template_bgr.shape[1] > screenshot_cv.shape[1]):
-                return False
-            result = cv2.matchTemplate(screenshot_cv, template_bgr, cv2.TM_CCOEFF_NORMED)
-            _, max_val, _, _ = cv2.minMaxLoc(result)
-            return max_val >= threshold
-        except Exception as e:
-            print(f"Template detection error: {e}")
-            return False
+class StateFailed(Exception):
+    """Raised by a state action whose condition did not show up within the state's timeout."""
 
-    def detect_book_on_screen(self):
-        return self.detect_template_on_screen(self.book_template, 0.8)
 
-    def detect_hijau_on_screen(self):
-        return self.detect_template_on_screen(self.hijau_template, 0.8)
+class WorkflowState:
+    """One state: action(run) does the work and returns the next state's name (None ends the run).
 
-    def detect_order_on_screen(self):
-        return self.detect_template_on_screen(self.order_template, 0.8)
+    timeout is the state's main wait, read by the action as run.state.timeout.
+    A StateFailed from the action runs on_fail and retries the state up to
+    retries times, then continues at fallback. on_enter / on_exit run around
+    every attempt.
+    """
 
-    def capture_region(self, x1, y1, x2, y2):
-        try:
-            screenshot = ImageGrab.grab(bbox=(x1, y1, x2, y2))
-            screenshot_np = np.array(screenshot)
-            screenshot_cv = cv2.cvtColor(screenshot_np, cv2.COLOR_RGB2BGR)
-            return screenshot_cv
-        except Exception as e:
-            print(f"Capture error: {e}")
-            return None
+    def __init__(self, name, action, timeout=None, retries=0, fallback=None,
+                 on_enter=None, on_exit=None, on_fail=None):
+        self.name = name
+        self.action = action
+        self.timeout = timeout
+        self.retries = retries
+        self.fallback = fallback
+        self.on_enter = on_enter
+        self.on_exit = on_exit
+        self.on_fail = on_fail
 
-    def detect_paper_in_slot(self, slot_roi):
-        if self.paper_template is None or self.paper_template_gray is None or slot_roi.size == 0:
-            return False, 0.0
-        try:
-            template_h, template_w = self.paper_template.shape[:2]
-            if slot_roi.shape[0] < template_h * 0.5 or slot_roi.shape[1] < template_w * 0.5:
-                return False, 0.0
-            slot_gray = cv2.cvtColor(slot_roi, cv2.COLOR_BGR2GRAY)
-            scales = [0.5, 0.6, 0.7, 0.8, 0.9, 1.0, 1.1, 1.2, 1.3, 1.4, 1.5]
-            max_confidence = 0.0
-            for scale in scales:
-                width = int(self.paper_template_gray.shape[1] * scale)
-                height = int(self.paper_template_gray.shape[0] * scale)
-                if width > slot_gray.shape[1] or height > slot_gray.shape[0]:
-                    continue
-                if width < 5 or height < 5:
-                    continue
-                scaled_template = cv2.resize(self.paper_template_gray, (width, height))
-                result = cv2.matchTemplate(slot_gray, scaled_template, cv2.TM_CCOEFF_NORMED)
-                _, max_val, _, _ = cv2.minMaxLoc(result)
-                if max_val > max_confidence:
-                    max_confidence = max_val
-            is_paper = max_confidence >= self.paper_match_threshold
-            return is_paper, max_confidence
-        except Exception:
-            return False, 0.0
 
-    def find_slot_rects(self, img):
-        """Find inventory slot rectangles (sorted top-left, max 27)."""
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-        edges = cv2.Canny(blurred, 50, 150)
-        contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        slots = []
-        for contour in contours:
-            peri = cv2.arcLength(contour, True)
-            approx = cv2.approxPolyDP(contour, 0.04 * peri, True)
-            if len(approx) != 4:
-                continue
-            x, y, w, h = cv2.boundingRect(approx)
-            aspect_ratio = w / float(h)
-            if 0.7 < aspect_ratio < 1.3 and 10 < w < 150 and 10 < h < 150:
-                slots.append((x, y, w, h))
-        return sorted(slots, key=lambda s: (s[1], s[0]))
+class Workflow:
+    """Small engine that runs WorkflowStates until one returns None or should_stop() is set.
 
-    def classify_slot_for_count(self, slot_roi):
-        has_paper, _ = self.detect_paper_in_slot(slot_roi)
-        if has_paper or np.std(slot_roi) < self.threshold:
-            return "empty"
-        return "filled"
+    The current state name is kept in .current (None when idle), each state
+    is a STAGE_TIMER phase, and on_state(name) is called on every transition.
+    """
 
-    def is_filled_click_target(self, slot_roi):
-        has_paper, _ = self.detect_paper_in_slot(slot_roi)
-        if has_paper:
-            return False
-        gray_roi = cv2.cvtColor(slot_roi, cv2.COLOR_BGR2GRAY)
-        return np.var(gray_roi) > 1000
+    def __init__(self, states, should_stop=None, on_state=None):
+        self.states = {state.name: state for state in states}
+        self.should_stop = should_stop or (lambda: False)
+        self.on_state = on_state
+        self.current = None
 
-    def analyze_slots(self, img):
-        """Count empty/filled slots and return per-slot state for overlay drawing."""
-        if img is None:
-            return 0, 0, []
+    def run(self, start, run):
+        name = start
         try:
-            empty_count = 0
-            filled_count = 0
-            analyzed = []
-            for x, y, w, h in self.find_slot_rects(img)[:27]:
-                slot_roi = img[y:y + h, x:x + w]
-                if slot_roi.size == 0:
-                    continue
-                state = self.classify_slot_for_count(slot_roi)
-                analyzed.append((x, y, w, h, state))
-                if state == "empty":
-                    empty_count += 1
-                else:
-                    filled_count += 1
-            return empty_count, filled_count, analyzed
-        except Exception as e:
-            print(f"analyze_slots error: {e}")
-            return 0, 0, []
-
-    def detect_slots(self, img):
-        empty_count, filled_count, _ = self.analyze_slots(img)
-        return empty_count, filled_count
+            while name is not None and not self.should_stop():
+                state = self.states[name]
+                self.current = name
+                run.state = state
+                STAGE_TIMER.stage(name)
+                if self.on_state is not None:
+                    self.on_state(name)
+                name = self._attempt(state, run)
+        finally:
+            self.current = None
+            STAGE_TIMER.stage(None)
+
+    @staticmethod
+    def _attempt(state, run):
+        attempts = 0
+        while True:
+            if state.on_enter is not None:
+                state.on_enter(run)
+            try:
+                return state.action(run)
+            except StateFailed:
+                if state.on_fail is not None:
+                    state.on_fail(run)
+                attempts += 1
+                if attempts > state.retries:
+                    return state.fallback
+            finally:
+                if state.on_exit is not None:
+                    state.on_exit(run)
+
+
+class SellPlanner:
+    """Plans where the next listings come from so a run needs the fewest GUI round trips.
+
+    Selling what is already on the hotbar is free. A backpack trip (E, take,
+    E) and an /order trip (chat command, three menu clicks, close) are costed
+    in chat commands plus GUI transitions. An /order pass may collect more
+    than the hotbar holds: the overflow lands in free backpack slots and is
+    fetched with backpack trips, which are cheaper than another /order.
+    """
 
-    def draw_slot_overlay(self, img, analyzed):
-        output = img.copy()
-        for x, y, w, h, state in analyzed:
-            color = (0, 255, 0) if state == "empty" else (0, 0, 255)
-            cv2.rectangle(output, (x, y), (x + w, y + h), color, 2)
-        return output
+    HOTBAR_SLOTS = MAX_ITEMS_PER_ORDER_SEQUENCE
+    BACKPACK_TRIP_COST = 2
+    ORDER_TRIP_COST = 5
 
-    def get_empty_slot_count(self):
-        img = self.capture_region(self.x1, self.y1, self.x2, self.y2)
-        empty, _ = self.detect_slots(img)
-        return empty
+    def plan(self, remaining, hotbar, backpack, backpack_free):
+        """Steps [(source, count), ...] that list `remaining` items; source is 'hotbar', 'backpack' or 'order'.
 
-    def _filled_clicks_from_image(self, img, region_x1, region_y1):
-        clicks = []
-        for x, y, w, h in self.find_slot_rects(img)[:27]:
-            slot_roi = img[y:y + h, x:x + w]
-            if slot_roi.size == 0:
-                continue
-            if self.is_filled_click_target(slot_roi):
-                clicks.append((region_x1 + x + w // 2, region_y1 + y + h // 2))
-        return clicks
+        hotbar / backpack are known block counts; backpack None means the
+        backpack has not been looked at yet, which plans one trip to find out.
+        backpack_free is how many collected items may overflow into it.
+        """
+        steps = []
+        take = min(remaining, hotbar)
+        if take > 0:
+            steps.append(('hotbar', take))
+            remaining -= take
+        if remaining <= 0:
+            return steps
+        if backpack is None:
+            steps.append(('backpack', min(remaining, self.HOTBAR_SLOTS)))
+            return steps
+        while backpack > 0 and remaining > 0:
+            take = min(remaining, backpack, self.HOTBAR_SLOTS)
+            steps.append(('backpack', take))
+            backpack -= take
+            remaining -= take
+        if remaining > 0:
+            steps += self._order_steps(remaining, backpack_free)
+        return steps
+
+    def _order_steps(self, remaining, backpack_free):
+        """Cheapest split of `remaining` into /order passes plus the backpack trips their overflow needs."""
+        sizes = set(range(self.HOTBAR_SLOTS, self.HOTBAR_SLOTS + backpack_free + 1, self.HOTBAR_SLOTS))
+        sizes.add(self.HOTBAR_SLOTS + backpack_free)
+        best = None
+        for size in sorted(sizes):
+            steps = []
+            left = remaining
+            while left > 0:
+                take = min(size, left)
+                steps.append(('order', take))
+                overflow = take - self.HOTBAR_SLOTS
+                while overflow > 0:
+                    steps.append(('backpack', min(overflow, self.HOTBAR_SLOTS)))
+                    overflow -= self.HOTBAR_SLOTS
+                left -= take
+            if best is None or self.cost(steps) < self.cost(best):
+                best = steps
+        return best
+
+    def cost(self, steps):
+        trip_costs = {'hotbar': 0, 'backpack': self.BACKPACK_TRIP_COST, 'order': self.ORDER_TRIP_COST}
+        return sum(trip_costs[source] for source, _ in steps)
+
+    @staticmethod
+    def describe(steps):
+        return ", ".join(f"{source} {count}" for source, count in steps) or "nothing"
+
+
+class TimingCalibrator:
+    """Per-step waits learned online from how long the game took to show each action.
+
+    mark() notes when an input goes out and observe() takes the time from
+    there to the first frame showing its effect. Once a step has
+    MIN_SAMPLES, wait() is the PERCENTILE of the last WINDOW plus MARGIN,
+    kept between FLOOR and CEILING times the step's default. missed()
+    records a wait that ran out as GROWTH times its length and lifts the
+    wait to at least that at once, so a retry of the same action already
+    waits longer; fresh observations bring it back down. A step with
+    nothing to watch also takes every sample of the step BORROW names, in
+    its own window, so its misses stay its own.
+    Samples persist between runs.
+    """
 
-    def get_backpack_filled_clicks(self):
-        img = self.capture_region(self.bp_x1, self.bp_y1, self.bp_x2, self.bp_y2)
-        if img is None:
-            return []
+    FILENAME = 'timing_cache.json'
+    WINDOW = 50
+    MIN_SAMPLES = 5
+    PERCENTILE = 95
+    MARGIN = 0.1
+    GROWTH = 1.5
+    FLOOR = 0.02
+    CEILING = 4.0
+    # A chat command's GUI takes the same server round trip as one a click opens.
+    BORROW = {'command': 'server_gui'}
+
+    def __init__(self, defaults=TIMING_STEPS, samples=None):
+        self.defaults = dict(defaults)
+        self._samples = {step: collections.deque(maxlen=self.WINDOW) for step in self.defaults}
+        for step, values in (samples or {}).items():
+            if step in self._samples:
+                self._samples[step].extend(float(v) for v in values)
+        self._waits = {step: self._learned(step) for step in self.defaults}
+        # monotonic() when the input whose effect is awaited went out; None once it is used up.
+        self.action_time = None
+
+    def wait(self, step):
+        return self._waits[step]
+
+    def mark(self):
+        self.action_time = time.monotonic()
+
+    def observe(self, step):
+        """One sample of step: the time since mark(). Without a mark nothing is recorded."""
+        if self.action_time is None:
+            return
+        seconds = time.monotonic() - self.action_time
+        self.action_time = None
+        self._add(step, seconds)
+
+    def missed(self, step, waited):
+        self.action_time = None
+        grown = waited * self.GROWTH
+        self._add(step, grown)
+        self._waits[step] = max(self._waits[step], min(grown, self.defaults[step] * self.CEILING))
+
+    def _add(self, step, seconds):
+        for name in self.defaults:
+            if name == step or self.BORROW.get(name) == step:
+                self._samples[name].append(seconds)
+                self._waits[name] = self._learned(name)
+
+    def _learned(self, step):
+        values = self._samples[step]
+        default = self.defaults[step]
+        if len(values) < self.MIN_SAMPLES:
+            return default
+        wait = float(np.percentile(np.fromiter(values, float), self.PERCENTILE)) + self.MARGIN
+        return min(max(wait, self.FLOOR), default * self.CEILING)
+
+    def describe(self):
+        return ", ".join(f"{step} {wait * 1000:.0f}ms" for step, wait in self._waits.items())
+
+    @classmethod
+    def load(cls):
+        data = load_json_cache(cls.FILENAME)
         try:
-            return self._filled_clicks_from_image(img, self.bp_x1, self.bp_y1)
-        except Exception as e:
-            print(f"get_backpack_filled_clicks error: {e}")
-            return []
+            return cls(samples=data.get('samples'))
+        except (AttributeError, TypeError, ValueError):
+            return cls()
+
+    def save(self):
+        save_json_cache(self.FILENAME, {
+            'samples': {step: [round(v, 4) for v in values] for step, values in self._samples.items()},
+        })
+
+
+class InventoryModel:
+    """What the bot believes is in the hotbar, the backpack and its AH listings.
+
+    Every action the bot takes updates it optimistically; vision is only
+    read at checkpoints (run start, after a GUI closes, on each sale's confirming frame)
+    and the observe_* methods adopt what was seen and count the slots that
+    disagreed as desyncs. The AH listing count is reused by a run that
+    starts right after the last one instead of opening /ah again; after
+    AH_LISTINGS_MAX_IDLE without the bot listing anything, or once a sale
+    is rejected, the player may have changed the listings by hand, so it is
+    scanned again.
+    """
+
+    HOTBAR_SLOTS = MAX_ITEMS_PER_ORDER_SEQUENCE
+    BACKPACK_SLOTS = 27
+    AH_SLOTS = 27
+    # Listings sold by other players only free slots, so a count kept while the bot is busy never overfills.
+    AH_LISTINGS_MAX_IDLE = 30
+
+    def __init__(self):
+        self.hotbar = [False] * self.HOTBAR_SLOTS
+        self.hotbar_known = False
+        # Backpack block count (None until opened) and free slots collected items may overflow into.
+        self.backpack = None
+        self.backpack_free = 0
+        self.ah_listings = None
+        # When the bot last scanned or listed on the AH.
+        self.ah_used_at = 0.0
+        self.desyncs = 0
+
+    def forget_player_inventory(self):
+        """The player may have moved items between runs; only the AH count carries over."""
+        self.hotbar = [False] * self.HOTBAR_SLOTS
+        self.hotbar_known = False
+        self.backpack = None
+        self.backpack_free = 0
+
+    @property
+    def hotbar_count(self):
+        return sum(self.hotbar)
+
+    @property
+    def hotbar_free(self):
+        return self.HOTBAR_SLOTS - self.hotbar_count
+
+    def ah_empty_slots(self):
+        """Empty AH slots from the remembered count, or None if it is unknown or the bot has been idle."""
+        if self.ah_listings is None or time.monotonic() - self.ah_used_at > self.AH_LISTINGS_MAX_IDLE:
+            return None
+        return self.AH_SLOTS - self.ah_listings
+
+    def observe_ah(self, filled):
+        self.ah_listings = filled
+        self.ah_used_at = time.monotonic()
+
+    def observe_hotbar(self, filled):
+        """Adopt a hotbar read; returns the slots the model had as empty that vision shows filled."""
+        reappeared = [i for i, has in enumerate(filled) if has and not self.hotbar[i]]
+        if self.hotbar_known:
+            self.desyncs += sum(has != was for has, was in zip(filled, self.hotbar))
+        self.hotbar = list(filled)
+        self.hotbar_known = True
+        return reappeared
+
+    def observe_backpack(self, filled):
+        self.backpack = filled
+        self.backpack_free = self.BACKPACK_SLOTS - filled
+
+    def backpack_unusable(self):
+        self.backpack = 0
+        self.backpack_free = 0
+
+    def block_slots(self):
+        return [i for i, has in enumerate(self.hotbar) if has]
+
+    def sold(self, slot):
+        self.hotbar[slot] = False
+        if self.ah_listings is not None:
+            self.ah_listings += 1
+            self.ah_used_at = time.monotonic()
+
+    def unsold(self):
+        """A sale the checkpoint showed did not go through: the AH may hold more than counted, so forget the count."""
+        self.ah_listings = None
+
+    def moved_to_player(self, count, from_backpack=False):
+        """Shift-clicked items fill free hotbar slots; from a container the rest overflows into the backpack."""
+        if from_backpack and self.backpack is not None:
+            self.backpack = max(0, self.backpack - count)
+            self.backpack_free = self.BACKPACK_SLOTS - self.backpack
+        for i in range(self.HOTBAR_SLOTS):
+            if count and not self.hotbar[i]:
+                self.hotbar[i] = True
+                count -= 1
+        if count and not from_backpack:
+            self.backpack = (self.backpack or 0) + count
+            self.backpack_free = max(0, self.backpack_free - count)
+        return count
+
+
+class SellRun:
+    """Mutable data the sell workflow's states share during one automation run."""
+
+    def __init__(self, sell_price, order_option):
+        self.sell_command = f"/ah sell {sell_price}"
+        self.order_option = order_option
+        # Empty AH slots still to fill.
+        self.remaining = 0
+        # Items the last backpack / order pass moved to the hotbar, and how many that pass aimed for.
+        self.moved = 0
+        self.collect_count = 0
+        self.plan = []
+        # Sell batches in a row that vision showed had not sold anything.
+        self.failed_batches = 0
+        # AH scans in a row that read no slot at all.
+        self.failed_scans = 0
+        self.state = None
+
+    def planned(self, source, default):
+        """Count of the plan's next step if it takes from source, else default."""
+        if self.plan and self.plan[0][0] == source:
+            return self.plan[0][1]
+        return default
 
-    def get_filled_clicks_in_region(self, x1, y1, x2, y2):
-        img = self.capture_region(x1, y1, x2, y2)
-        if img is None:
-            return []
-        try:
-            return self._filled_clicks_from_image(img, x1, y1)
-        except Exception as e:
-            print(f"get_filled_clicks_in_region error: {e}")
-            return []
 
 class BotSignals(QObject):
     update_status = Signal(str, str)
@@ -728,10 +3333,18 @@ class MainWindow(QMainWindow):
     HOTBAR_BOX_THICKNESS_SELECTED = 3
     # Hotbar preview only appears when any slot reaches this variance.
     HOTBAR_MIN_VARIANCE_TO_SHOW = 4359
+    CHEST_MODE_LABELS = {'chest': "Auction", 'backpack': "Backpack", 'order': "Order"}
+    # Stage timings overlay (only with --timings): stages with the most total time first.
+    TIMING_OVERLAY_ROWS = 5
+    MAX_FAILED_SELL_BATCHES = 3
+    MAX_FAILED_SCANS = 2
+    # The client rect must hold still this long after the start hotkey maximizes the window.
+    START_SETTLE_S = 0.25
     WINDOW_SPAWN_X = 1150
     WINDOW_SPAWN_Y = 209
 
-    def __init__(self):
+    def __init__(self, capture=None, inputs=None, headless=False):
+        """headless skips hotkeys, background loops and window handling (used by replays)."""
         super().__init__()
         self.setWindowTitle("Auto")
         self.setWindowIcon(QIcon(resource_path('auto.ico')))
@@ -769,9 +3382,23 @@ class MainWindow(QMainWindow):
         self.setFixedSize(self.width(), self.height())
         self.move(self.WINDOW_SPAWN_X, self.WINDOW_SPAWN_Y)
 
-        self.detector = InventoryDetector()
-        self.hotbar_detector = HotbarDetector()
-        self.mouse = mouse.Controller()
+        self.headless = headless
+        self.record_dir = None
+        self.timings_path = None
+        self.trace_path = None
+        self.screen_capture = capture if capture is not None else ScreenCapture()
+        self.detector = InventoryDetector(self.screen_capture)
+        self.hotbar_detector = HotbarDetector(self.screen_capture)
+        self.apply_layout(LayoutProfile.load())
+        self.inputs = inputs if inputs is not None else PyAutoGuiInput()
+        self.planner = SellPlanner()
+        self.timing = TimingCalibrator.load()
+        # Shift-clicks jump the pointer to each slot instead of hovering first; _pointer is where it was left.
+        self.transfer_teleport = False
+        self._pointer = None
+        self.transfer_strategies = TRANSFER_STRATEGIES
+        self.inventory = InventoryModel()
+        self.workflow = self._build_sell_workflow()
 
         self.running = False
         self.stop_requested = False
@@ -779,6 +3406,16 @@ class MainWindow(QMainWindow):
         self.bot_signals = BotSignals()
         self.bot_signals.update_status.connect(self.update_status)
 
+        self.hotbar_running = False
+        self._maximize_running = False
+        self.chest_monitoring = False
+        # Main-thread only: drop stale ch_update_display events queued after we reset (MODE N/A).
+        self._accept_chest_preview_updates = False
+        self.chest_active_region = 'chest'
+        if headless:
+            return
+        self.screen_capture.start()
+
         try:
             keyboard.add_hotkey('ctrl+o', self.toggle_automation)
         except Exception as e:
@@ -786,23 +3423,44 @@ class MainWindow(QMainWindow):
 
         # Start detector threads
         self.hotbar_running = True
-        self.hotbar_thread = threading.Thread(target=self.hotbar_detection_loop, daemon=True)
+        self.hotbar_thread = threading.Thread(target=self.hotbar_detection_loop, name="hotbar-loop", daemon=True)
         self.hotbar_thread.start()
 
-        self.chest_monitoring = False
-        # Main-thread only: drop stale ch_update_display events queued after we reset (MODE N/A).
-        self._accept_chest_preview_updates = False
-        self.chest_active_region = 'chest'
-        self.chest_book_thread = threading.Thread(target=self.book_detection_loop, daemon=True)
+        self.chest_book_thread = threading.Thread(target=self.book_detection_loop, name="book-loop", daemon=True)
         self.chest_book_thread.start()
 
         QTimer.singleShot(0, self._defocus_price_input)
 
+        if STAGE_TIMER.enabled:
+            self._timing_timer = QTimer(self)
+            self._timing_timer.timeout.connect(self._refresh_timing_overlay)
+            self._timing_timer.start(1000)
+
         self._maximize_running = True
         maximize_minecraft_window()
-        self._maximize_thread = threading.Thread(target=self._maximize_loop, daemon=True)
+        self._maximize_thread = threading.Thread(target=self._maximize_loop, name="maximize", daemon=True)
         self._maximize_thread.start()
 
+    def _refresh_timing_overlay(self):
+        stages = sorted(STAGE_TIMER.summary().items(), key=lambda item: -item[1]['total'])
+        rows = [
+            f"{name} {s['count']}× {s['mean'] * 1000:.0f}ms p95 {s['p95'] * 1000:.0f}ms"
+            for name, s in stages[:self.TIMING_OVERLAY_ROWS - 1]
+        ]
+        rows += [" "] * (self.TIMING_OVERLAY_ROWS - 1 - len(rows))
+        rows.insert(0, f"state: {self.automation_state or 'idle'}")
+        self.timing_label.setText("\n".join(rows))
+
+    def dump_timings(self):
+        """Write the --timings summary and the --trace file, if requested."""
+        try:
+            if self.timings_path is not None:
+                STAGE_TIMER.dump(self.timings_path)
+            if self.trace_path is not None and STAGE_TIMER.trace is not None:
+                STAGE_TIMER.trace.save(self.trace_path)
+        except OSError as e:
+            print(f"Could not write timings: {e}")
+
     def _defocus_price_input(self):
         self.price_input.clearFocus()
         self.order_input.clearFocus()
@@ -851,6 +3509,7 @@ class MainWindow(QMainWindow):
                 self.preview_wait_label.setStyleSheet(preview_style)
             self.hotbar_img_label.setStyleSheet(preview_style)
             self.chest_img_label.setStyleSheet(preview_style)
+            self.timing_label.setStyleSheet(self._progress_label_stylesheet())
             self._refresh_stat_value_styles()
         self.adjustSize()
         self.setFixedSize(self.width(), self.height())
@@ -1051,6 +3710,11 @@ class MainWindow(QMainWindow):
         preview_stack.addWidget(self.chest_img_label, alignment=Qt.AlignHCenter)
 
         body_layout.addWidget(self.preview_panel, alignment=Qt.AlignHCenter)
+
+        self.timing_label = QLabel("\n".join([" "] * self.TIMING_OVERLAY_ROWS))
+        self.timing_label.setFixedWidth(preview_w)
+        self.timing_label.setVisible(STAGE_TIMER.enabled)
+        body_layout.addWidget(self.timing_label, alignment=Qt.AlignHCenter)
         layout.addWidget(body, 0)
 
         self.hb_signals = HotbarSignals()
@@ -1193,7 +3857,7 @@ class MainWindow(QMainWindow):
                 maximize_minecraft_window()
             except Exception:
                 pass
-            time.sleep(2)
+            pause(2)
 
     def _cleanup_background(self):
         self._maximize_running = False
@@ -1202,6 +3866,8 @@ class MainWindow(QMainWindow):
         self.chest_monitoring = False
         self.running = False
         self.stop_requested = True
+        self.screen_capture.stop()
+        self.dump_timings()
         try:
             keyboard.unhook_all_hotkeys()
         except Exception:
@@ -1246,6 +3912,7 @@ class MainWindow(QMainWindow):
         super().mouseDoubleClickEvent(event)
 
     @Slot(str, str)
+    @timed('ui.update_status')
     def update_status(self, message, progress):
         self.status_label.setText(message)
         self.progress_label.setText(progress)
@@ -1265,7 +3932,7 @@ class MainWindow(QMainWindow):
             print("Note: Minecraft window not found (title must contain 'Minecraft', not 'Launcher').")
         self.current_sell_price = self._sell_price_for_command()
         self.current_order_option = self.order_input.value()
-        automation_thread = threading.Thread(target=self.run_automation, daemon=True)
+        automation_thread = threading.Thread(target=self._automation_thread_main, name="automation", daemon=True)
         automation_thread.start()
 
     def stop_automation(self):
@@ -1273,66 +3940,246 @@ class MainWindow(QMainWindow):
             self.stop_requested = True
             self.bot_signals.update_status.emit("Stopping", "wait")
 
+    def _automation_thread_main(self):
+        try:
+            self._run_automation_recorded()
+        finally:
+            self.dump_timings()
+
+    def _run_automation_recorded(self):
+        if self.record_dir is None:
+            self.run_automation()
+            return
+        path = os.path.join(self.record_dir, time.strftime("session-%Y%m%d-%H%M%S.zip"))
+        recorder = SessionRecorder(path, meta={
+            'sell_price': self.current_sell_price,
+            'order_option': self.current_order_option,
+            'layout': self.layout.to_dict(),
+        })
+        live_inputs = self.inputs
+        self.inputs = RecordingInput(live_inputs, recorder)
+        self.screen_capture.recorder = recorder
+        self.bot_signals.update_status.connect(recorder.status)
+        try:
+            self.run_automation()
+        finally:
+            self.bot_signals.update_status.disconnect(recorder.status)
+            self.screen_capture.recorder = None
+            self.inputs = live_inputs
+            try:
+                print(f"Session recorded to {recorder.save()}")
+            except Exception as e:
+                print(f"Session save error: {e}")
+
+    def apply_layout(self, profile):
+        """Point capture, detectors and click targets at one layout profile."""
+        self.layout = profile
+        self.screen_capture.set_bbox(profile.capture_bbox())
+        self.hotbar_detector.apply_layout(profile)
+        self.detector.apply_layout(profile)
+
+    def calibrate_layout(self):
+        """Re-derive the layout from the live client area; keeps the current one on failure."""
+        profile = LayoutCalibrator(self.screen_capture).calibrate()
+        if profile is None:
+            return False
+        if profile.to_dict() != self.layout.to_dict():
+            self.apply_layout(profile)
+            profile.save()
+        return True
+
     # --- Automation Logic ---
-    def wait_for_hotbar_block(self, retries=15, delay=0.12):
-        """Retry: after /order collect or UI changes, hotbar vision often lags one or two frames."""
-        for _ in range(retries):
-            has_block, _ = self.hotbar_detector.check_any_slot_has_block()
-            if has_block and self.hotbar_detector.scroll_to_block_slot(self.mouse):
+    def wait_until(self, predicate, timeout):
+        """Return True as soon as predicate() holds, re-checking once per captured frame.
+
+        timeout is the old fixed sleep: on a responsive server most waits end
+        within a frame or two. Returns False on timeout or stop request.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            if predicate():
                 return True
-            time.sleep(delay)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self.stop_requested:
+                return False
+            self.screen_capture.wait_for_frame(remaining)
+
+    def wait_for_effect(self, step, predicate, timeout=None):
+        """wait_until for the effect of the input last passed to timing.mark(), timing it for the calibrator.
+
+        Without a timeout the step's learned wait, counted from the mark, is
+        used and running out counts as a miss; an explicit timeout is a
+        failure limit, not a latency. An effect already showing on the first
+        look landed during some earlier sleep, so it is not timed.
+        """
+        if predicate():
+            self.timing.action_time = None
+            return True
+        learned = timeout is None
+        if learned:
+            timeout = self.timing.wait(step)
+            if self.timing.action_time is not None:
+                timeout -= time.monotonic() - self.timing.action_time
+        if self.wait_until(predicate, timeout):
+            self.timing.observe(step)
+            return True
+        if learned and not self.stop_requested:
+            self.timing.missed(step, self.timing.wait(step))
+        else:
+            self.timing.action_time = None
         return False
 
-    def sell_one_item(self):
-        pyautogui.press('t')
-        pyautogui.hotkey('ctrl', 'v')
-        pyautogui.press('enter')
-        pyautogui.click(1101, 364, duration=0.3)
-        self.mouse.scroll(0, 1)
+    def gui_open(self, gui):
+        return self.detector.classify_screen().is_open(gui)
+
+    def _settled(self, region):
+        """wait_until predicate: true once two successive frames show the same slot grid; a failed grab is not settled."""
+        gate = FrameChangeGate()
+        box = self.detector.region_box(region)
+
+        def settled():
+            img = self.detector.capture_region(*box)
+            return img is not None and not gate.changed(img)
+        return settled
+
+    def _ready_to_start(self):
+        """wait_until predicate: Minecraft has focus, Ctrl+O's modifiers are released and the
+        client rect has not changed for START_SETTLE_S."""
+        last = {'rect': None, 'since': 0.0}
+
+        def ready():
+            rect = get_minecraft_client_rect()
+            now = time.monotonic()
+            if rect != last['rect']:
+                last['rect'], last['since'] = rect, now
+            if any(keyboard.is_pressed(key) for key in ('ctrl', 'shift', 'alt')):
+                return False
+            return (minecraft_has_focus() and rect is not None
+                    and now - last['since'] >= self.START_SETTLE_S)
+        return ready
+
+    @timed('wait_for_gui')
+    def wait_for_gui(self, gui, timeout=5):
+        """Wait until gui ('chest' / 'backpack' / 'order') is open."""
+        return self.wait_until(lambda: self.gui_open(gui), timeout)
+
+    @timed('sell_one_item')
+    def sell_one_item(self, close_delay=GUI_CLOSE_DELAY):
+        self.inputs.run([
+            InputStep('press', ('t',), CHAT_OPEN_DELAY),
+            InputStep('hotkey', ('ctrl', 'v')),
+            InputStep('press', ('enter',), self.timing.wait('command')),
+        ])
+        self.timing.mark()
+        self.inputs.run([InputStep('click', self.layout.click('sell_confirm'), close_delay)])
+
+    @timed('sell_confirm')
+    def _await_sale(self, slot):
+        """Hotbar read of the first frame showing slot empty, or None if none does in time.
+
+        The sell screen's dark overlay can make a filled slot read empty, so
+        a frame only counts once every other slot the model holds as filled
+        still reads filled and no container GUI is open. In time is the
+        learned 'sell_confirm' wait; a miss lengthens it and the sale gets
+        the longer wait once more before it counts as lost.
+        """
+        others = self.inventory.block_slots()
+        seen = [None]
+
+        def emptied():
+            filled = seen[0] = self.hotbar_detector.read_slots()
+            return (filled is not None and not filled[slot] and all(filled[i] for i in others)
+                    and self.detector.classify_screen().gui is None)
+
+        if self.wait_for_effect('sell_confirm', emptied):
+            return seen[0]
+        started = time.monotonic()
+        if self.wait_until(emptied, self.timing.wait('sell_confirm')):
+            return seen[0]
+        if not self.stop_requested:
+            self.timing.missed('sell_confirm', time.monotonic() - started)
+        return None
 
     def _close_inventory_twice(self):
         """Close AH / backpack UIs (press E twice)."""
-        pyautogui.press('e')
-        time.sleep(0.3)
-        pyautogui.press('e')
-        time.sleep(0.3)
-
-    def _transfer_with_shift_click(self, positions, status_prefix, progress_suffix="", stop_callback=None):
+        self.timing.mark()
+        self.inputs.press('e')
+        self.wait_for_effect('gui_close', lambda: not self.gui_open('chest'))
+        # The AH main menu has no template to confirm it closed.
+        self.inputs.press('e')
+        pause(self.timing.wait('gui_close'))
+
+    def _close_stray_screen(self):
+        """Escape out of what a lost input or a slow server left open: chat holding a command, or the sell screen.
+
+        Neither has a template to watch. If the world was showing after all,
+        Escape opens the pause menu instead; the AH scan that then fails
+        comes back here, which closes it.
+        """
+        self.inputs.press('escape')
+        pause(self.timing.wait('gui_close'))
+
+    @timed('shift_click_batch')
+    def _transfer_with_shift_click(self, positions, status_prefix, progress_suffix="", stop_callback=None, region=None,
+                                   take_all=False):
+        """Shift-move positions with the cheapest gestures plan_transfer allows; returns how many slots it clicked or swept.
+
+        Single clicks follow a serpentine path and, with a region name, wait
+        only until their slot reads empty (at most the learned 'transfer' wait).
+        Drags and double-clicks are not confirmed per slot; the caller's
+        recount checks them. take_all allows a double-click, which moves every
+        matching stack. In teleport mode clicks skip the hover step.
+        """
         if not positions:
             return 0
 
+        gestures = plan_transfer(positions, take_all, self.transfer_strategies, start=self._pointer)
         clicked = 0
-        prev_y = None
-        pyautogui.keyDown('shift')
-        time.sleep(0.05)
+        self.inputs.key_down('shift')
+        pause(0.05)
         try:
-            for i, pos in enumerate(positions):
+            for strategy, targets in gestures:
                 if self.stop_requested:
                     break
                 if stop_callback is not None and stop_callback():
                     break
 
-                # Row transition needs a short settle time, but 0.5s is too slow.
-                row_changed = prev_y is not None and abs(pos[1] - prev_y) > 20
-                if row_changed:
-                    time.sleep(0.15)
-                prev_y = pos[1]
-
-                pyautogui.moveTo(pos[0], pos[1], duration=0.08)
-                pyautogui.click(pos[0], pos[1], duration=0.06)
-                time.sleep(0.08)
-                clicked += 1
+                if strategy == 'double':
+                    self.inputs.run([InputStep('click', targets[0]), InputStep('click', targets[0], SLOT_CLICK_DELAY)])
+                    # Only stacks matching the clicked item follow it; the caller's recount finds out how many.
+                    moved = 1
+                elif strategy == 'drag':
+                    steps = [InputStep('move_to', targets[0], SLOT_HOVER_DELAY), InputStep('mouse_down')]
+                    steps += [InputStep('move_to', pos, DRAG_STEP_DELAY) for pos in targets[1:]]
+                    self.inputs.run(steps + [InputStep('mouse_up', (), SLOT_CLICK_DELAY)])
+                    moved = len(targets)
+                else:
+                    pos = targets[0]
+                    if not self.transfer_teleport:
+                        self.inputs.run([InputStep('move_to', pos, SLOT_HOVER_DELAY)])
+                    self.timing.mark()
+                    self.inputs.click(*pos)
+                    if region is None:
+                        pause(SLOT_CLICK_DELAY)
+                    else:
+                        # A missed confirmation only costs the timeout; the caller's recount still catches the slot.
+                        self.wait_for_effect('transfer', lambda: self.detector.slot_filled_at(region, pos) is False)
+                    moved = 1
+                self._pointer = targets[-1]
+                clicked += moved
                 self.bot_signals.update_status.emit(
-                    f"{status_prefix} {i+1}/{len(positions)}",
+                    f"{status_prefix} {clicked}/{len(positions)}",
                     progress_suffix
                 )
         finally:
-            pyautogui.keyUp('shift')
-            time.sleep(0.05)
+            self.inputs.key_up('shift')
+            pause(0.05)
 
         return clicked
 
-    def _collect_with_verification(self, fetch_positions, target_count, status_prefix, progress_suffix="", stop_callback=None):
+    @timed('collect_verified')
+    def _collect_with_verification(self, fetch_positions, target_count, status_prefix, progress_suffix="", stop_callback=None,
+                                   region=None):
         """
         Shift-click items from a source region and verify real transfers by recounting.
         Returns how many items actually left the source region.
@@ -1362,20 +4209,25 @@ class MainWindow(QMainWindow):
 
             before_count = len(positions)
             need = target_count - moved_total
-            # Hotbar holds MAX_ITEMS_PER_ORDER_SEQUENCE slots; also respect remaining click budget.
-            batch = positions[: min(need, MAX_ITEMS_PER_ORDER_SEQUENCE, click_budget)]
+            # Callers size target_count to the room they have (hotbar plus any planned backpack overflow),
+            # so move everything still needed and recount once per round. Positions come in reading
+            # order, so each row's share is its leftmost slots, which a drag can sweep.
+            batch = positions[: min(need, click_budget)]
             clicked = self._transfer_with_shift_click(
                 batch,
                 status_prefix,
                 progress_suffix,
-                stop_callback=stop_callback
+                stop_callback=stop_callback,
+                region=region,
+                take_all=len(batch) == before_count,
             )
             total_shift_clicks += clicked
             if clicked == 0:
                 break
 
-            # Give UI/inventory a moment to update before recounting.
-            time.sleep(0.12)
+            # One recount per round: wait until the source shows every targeted slot gone.
+            expected = before_count - len(batch)
+            self.wait_until(lambda: len(fetch_positions()) <= expected, self.timing.wait('transfer'))
             after_count = len(fetch_positions())
             moved_now = max(0, before_count - after_count)
 
@@ -1383,7 +4235,7 @@ class MainWindow(QMainWindow):
                 stalled_rounds += 1
                 if stalled_rounds >= 2:
                     break
-                time.sleep(0.12)
+                pause(0.12)
                 continue
 
             stalled_rounds = 0
@@ -1391,324 +4243,480 @@ class MainWindow(QMainWindow):
 
         return min(target_count, moved_total)
 
+    @timed('drain_backpack')
     def drain_backpack(self):
         if self.stop_requested:
             return 0
         self.bot_signals.update_status.emit("Open BP", "")
-        pyautogui.press('e')
-        time.sleep(0.5)
-
-        wait_count = 0
-        while wait_count < 5:
-            if self.detector.detect_hijau_on_screen():
-                break
-            time.sleep(0.4)
-            wait_count += 0.4
+        self.inputs.press('e')
 
-        if not self.detector.detect_hijau_on_screen():
-            pyautogui.press('e')
-            time.sleep(0.3)
+        if not self.wait_for_gui('backpack'):
+            self.inputs.press('e')
+            pause(0.3)
             return 0
 
         filled_clicks = self.detector.get_backpack_filled_clicks()
         if not filled_clicks:
-            pyautogui.press('e')
-            time.sleep(0.3)
+            self.timing.mark()
+            self.inputs.press('e')
+            self.wait_for_effect('gui_close', lambda: not self.gui_open('backpack'))
             return 0
 
-        batch = filled_clicks[:MAX_ITEMS_PER_ORDER_SEQUENCE]
-        self.bot_signals.update_status.emit(f"Drain {len(batch)}", "")
-        moved = self._transfer_with_shift_click(
-            batch,
-            "Take",
-            "",
-            stop_callback=lambda: self.stop_requested
+        target = min(len(filled_clicks), MAX_ITEMS_PER_ORDER_SEQUENCE)
+        self.bot_signals.update_status.emit(f"Drain {target}", "")
+        # Recounted rounds: a double-click only takes stacks of the clicked item, so mixed contents need more.
+        moved = self._collect_with_verification(
+            fetch_positions=self.detector.get_backpack_filled_clicks,
+            target_count=target,
+            status_prefix="Take",
+            stop_callback=lambda: self.stop_requested,
+            region='backpack',
         )
         if self.stop_requested:
-            pyautogui.press('e')
+            self.inputs.press('e')
             return moved
 
-        pyautogui.press('e')
-        time.sleep(0.5)
+        self.timing.mark()
+        self.inputs.press('e')
+        self.wait_for_effect('gui_close', lambda: not self.gui_open('backpack'))
         return moved
 
+    def _build_sell_workflow(self):
+        """The automation as states; each action returns the next state's name, None ends the run."""
+        def close_after_failure(run):
+            self.inputs.press('e')
+            pause(0.3)
+
+        def backpack_failed(run):
+            # Give up on the backpack for this run: no more trips, nothing may overflow into it.
+            close_after_failure(run)
+            self.inventory.backpack_unusable()
+        return Workflow([
+            WorkflowState('prepare', self._state_prepare, timeout=2),
+            WorkflowState('open_ah', self._state_open_ah),
+            WorkflowState('scan_ah', self._state_scan_ah, timeout=5),
+            WorkflowState('close_ah', self._state_close_ah),
+            WorkflowState('plan', self._state_plan),
+            WorkflowState('sell_hotbar', self._state_sell_hotbar),
+            WorkflowState('open_backpack', self._state_open_backpack, timeout=5,
+                          fallback='plan', on_fail=backpack_failed),
+            WorkflowState('take_backpack', self._state_take_backpack, timeout=0.6,
+                          fallback='plan', on_fail=backpack_failed),
+            WorkflowState('sell_backpack', self._state_sell_backpack),
+            WorkflowState('open_order', self._state_open_order, timeout=0.6),
+            WorkflowState('collect', self._state_collect, timeout=1),
+            WorkflowState('sell_order', self._state_sell_order),
+            WorkflowState('complete', self._state_complete),
+        ], should_stop=lambda: self.stop_requested)
+
+    @property
+    def automation_state(self):
+        """Name of the workflow state the automation is in, or None when idle."""
+        return self.workflow.current if self.workflow is not None else None
+
     def run_automation(self):
+        run = SellRun(self.current_sell_price, self.current_order_option)
         try:
-            self.bot_signals.update_status.emit("Starting", "Preparing")
-            time.sleep(1)
-
-            self.bot_signals.update_status.emit("Open AH", "1/8")
-            pyautogui.press('t')
-            time.sleep(0.3)
-            pyautogui.write('/ah', interval=0.05)
-            pyautogui.press('enter')
-
-            if self.stop_requested: return self.cleanup()
-
-            self.bot_signals.update_status.emit("AH menu", "2/8")
-            pyautogui.click(1100, 540, duration=0.3)
-
-            if self.stop_requested: return self.cleanup()
-
-            self.bot_signals.update_status.emit("Scan AH", "3/8")
-            time.sleep(0.5)
-
-            wait_count = 0
-            while wait_count < 5:
-                if self.detector.detect_book_on_screen():
-                    break
-                time.sleep(0.5)
-                wait_count += 0.5
-
+            self.workflow.run('prepare', run)
+        except Exception as e:
+            self.bot_signals.update_status.emit(f"❌ {str(e)}", "stop")
+        if self.inventory.desyncs:
+            print(f"Inventory model corrected {self.inventory.desyncs} slot(s) from vision")
+        print(f"Learned waits: {self.timing.describe()}")
+        self.timing.save()
+        self.cleanup()
+
+    def _state_prepare(self, run):
+        self.bot_signals.update_status.emit("Starting", "Preparing")
+        if self.headless:
+            self.wait_until(minecraft_has_focus, run.state.timeout)
+        else:
+            # Typing starts only once the hotkey is let go, and the layout is read from the maximized window.
+            self.wait_until(self._ready_to_start(), run.state.timeout)
+            self.calibrate_layout()
+        self.inventory.forget_player_inventory()
+        self.inventory.desyncs = 0
+        empty_slots = self.inventory.ah_empty_slots()
+        if not empty_slots:
+            return 'open_ah'
+        # The bot is the only one adding listings, so a recent count saves the /ah round trip.
+        run.remaining = empty_slots
+        self.bot_signals.update_status.emit(f"{empty_slots} empty (known)", "3/8")
+        self.inputs.copy(run.sell_command)
+        return 'plan'
+
+    def _state_open_ah(self, run):
+        self.bot_signals.update_status.emit("Open AH", "1/8")
+        self.inputs.run([
+            InputStep('press', ('t',), 0.3),
+            InputStep('write', ('/ah', 0.05)),
+            InputStep('press', ('enter',), self.timing.wait('command')),
+        ])
+
+        if self.stop_requested: return None
+
+        self.bot_signals.update_status.emit("AH menu", "2/8")
+        # scan_ah times the chest opening from here.
+        self.timing.mark()
+        self.inputs.click(*self.layout.click('menu_button'))
+        return 'scan_ah'
+
+    def _state_scan_ah(self, run):
+        self.bot_signals.update_status.emit("Scan AH", "3/8")
+        empty_slots = filled_slots = 0
+        if self.wait_for_effect('server_gui', lambda: self.gui_open('chest'), run.state.timeout):
+            self.wait_until(self._settled('chest'), 0.5)
             ah_img = self.detector.capture_region(
                 self.detector.x1,
                 self.detector.y1,
                 self.detector.x2,
                 self.detector.y2,
             )
-            empty_slots, filled_slots, _ = self.detector.analyze_slots(ah_img)
-            self.bot_signals.update_status.emit(
-                f"{empty_slots} empty, {filled_slots} filled",
-                "3/8",
-            )
-            time.sleep(1)
-
-            if filled_slots >= 27 or empty_slots == 0:
-                self.bot_signals.update_status.emit(
-                    f"AH full {filled_slots}/27",
-                    "stop",
-                )
+            empty_slots, filled_slots, _ = self.detector.analyze_slots(ah_img, 'chest')
+
+        if not filled_slots and not empty_slots:
+            # A chest that never opened (a lost input, a stray screen took /ah) or read no slot is not a full AH.
+            run.failed_scans += 1
+            if run.failed_scans > self.MAX_FAILED_SCANS:
+                self.bot_signals.update_status.emit("❌ AH scan failed", "stop")
+                return None
+            self.bot_signals.update_status.emit("⚠ AH scan retry", "")
+            if self.gui_open('chest'):
                 self._close_inventory_twice()
-                return self.cleanup()
-
-            if self.stop_requested: return self.cleanup()
+            else:
+                self._close_stray_screen()
+            return 'open_ah'
+        run.failed_scans = 0
+        self.inventory.observe_ah(filled_slots)
+        self.bot_signals.update_status.emit(
+            f"{empty_slots} empty, {filled_slots} filled",
+            "3/8",
+        )
+        pause(1)
 
-            self.bot_signals.update_status.emit("Close", "4/8")
+        if filled_slots >= 27 or empty_slots == 0:
+            self.bot_signals.update_status.emit(
+                f"AH full {filled_slots}/27",
+                "stop",
+            )
             self._close_inventory_twice()
-            time.sleep(0.2)
-
-            remaining_empty = empty_slots
-            sell_command = f"/ah sell {self.current_sell_price}"
-            pyperclip.copy(sell_command)
-
-            while remaining_empty > 0:
-                if self.stop_requested: return self.cleanup()
-
-                while remaining_empty > 0:
-                    if self.stop_requested: return self.cleanup()
-                    has_block, _ = self.hotbar_detector.check_any_slot_has_block()
-                    if not has_block:
-                        break
-                    self.hotbar_detector.scroll_to_block_slot(self.mouse)
-                    self.bot_signals.update_status.emit("Sell hotbar", f"{remaining_empty} left")
-                    self.sell_one_item()
-                    remaining_empty -= 1
-                    if remaining_empty == 0:
-                        self.bot_signals.update_status.emit("✅ Hotbar done", "done")
-                        time.sleep(2)
-                        return self.cleanup()
-
-                self.bot_signals.update_status.emit("Open BP", f"{remaining_empty} left")
-                pyautogui.press('e')
-                time.sleep(0.5)
-
-                wait_count = 0
-                while wait_count < 5:
-                    if self.detector.detect_hijau_on_screen():
-                        break
-                    time.sleep(0.4)
-                    wait_count += 0.4
-
-                if not self.detector.detect_hijau_on_screen():
-                    pyautogui.press('e')
-                    time.sleep(0.3)
-                    break
-
-                time.sleep(0.3)
-                filled_clicks = self.detector.get_backpack_filled_clicks()
-
-                if not filled_clicks:
-                    pyautogui.press('e')
-                    time.sleep(0.3)
-                    break
-
-                # Hotbar holds 9 slots: take min(empty AH slots left, 9). If empty > 9, multiple backpack passes happen.
-                needed_this_batch = min(remaining_empty, MAX_ITEMS_PER_ORDER_SEQUENCE)
-                target_take = needed_this_batch
-                self.bot_signals.update_status.emit(f"Take ≤{target_take} BP", f"{remaining_empty} left")
-
-                moved = self._collect_with_verification(
-                    fetch_positions=self.detector.get_backpack_filled_clicks,
-                    target_count=target_take,
-                    status_prefix="Take",
-                    progress_suffix=f"{remaining_empty} left",
-                    stop_callback=lambda: self.stop_requested
-                )
-                if self.stop_requested:
-                    pyautogui.press('e')
-                    return self.cleanup()
-                if moved == 0:
-                    pyautogui.press('e')
-                    time.sleep(0.3)
-                    break
-
-                pyautogui.press('e')
-                time.sleep(0.6)
-
-                for i in range(moved):
-                    if self.stop_requested: return self.cleanup()
-                    if not self.wait_for_hotbar_block():
-                        self.bot_signals.update_status.emit("❌ No hotbar block", "stop")
-                        return self.cleanup()
-                    self.sell_one_item()
-                    remaining_empty -= 1
-                    self.bot_signals.update_status.emit(f"Sold {i+1}/{moved} BP", f"{remaining_empty} left")
-
-                if remaining_empty == 0:
-                    self.bot_signals.update_status.emit("✅ BP done", "done")
-                    time.sleep(2)
-                    return self.cleanup()
-
-            if self.stop_requested: return self.cleanup()
-
-            order_coords = { 1: (670, 300), 2: (740, 300), 3: (810, 300), 4: (880, 300) }
-            selected_coord = order_coords[self.current_order_option]
-
-            while remaining_empty > 0:
-                if self.stop_requested: return self.cleanup()
-
-                self.bot_signals.update_status.emit("Open order", f"{remaining_empty} to fill")
-                pyautogui.press('t')
-                time.sleep(0.3)
-                pyautogui.write('/order', interval=0.05)
-                pyautogui.press('enter')
-
-                if self.stop_requested: return self.cleanup()
+            return None
+        run.remaining = empty_slots
+        return 'close_ah'
+
+    def _state_close_ah(self, run):
+        self.bot_signals.update_status.emit("Close", "4/8")
+        self._close_inventory_twice()
+        pause(0.2)
+        self.inputs.copy(run.sell_command)
+        return 'plan'
+
+    def _state_plan(self, run):
+        self._check_hotbar()
+        return self._next_from_plan(run)
+
+    def _next_from_plan(self, run):
+        inventory = self.inventory
+        if inventory.ah_listings is None:
+            # A rejected sale dropped the count; rescan before listing more than the AH takes.
+            return 'open_ah'
+        run.plan = self.planner.plan(run.remaining, inventory.hotbar_count, inventory.backpack, inventory.backpack_free)
+        if STAGE_TIMER.trace is not None:
+            STAGE_TIMER.trace.instant('plan', remaining=run.remaining, steps=SellPlanner.describe(run.plan))
+        if not run.plan:
+            return 'complete'
+        return {'hotbar': 'sell_hotbar', 'backpack': 'open_backpack', 'order': 'open_order'}[run.plan[0][0]]
+
+    def _check_hotbar(self, wait=0):
+        """Checkpoint: read the hotbar and let the model adopt it; returns the slots that reappeared.
+
+        wait > 0 allows that long for the read to show any block or agree
+        with the model, as the hotbar lags a frame or two behind a GUI that
+        just closed; a hotbar the model expects empty returns at once.
+        """
+        seen = [None]
 
-                self.bot_signals.update_status.emit(f"Order #{self.current_order_option}", f"{remaining_empty} to fill")
-                pyautogui.click(1100, 540, duration=0.3)
-                time.sleep(0.5)
-                pyautogui.moveTo(selected_coord[0], selected_coord[1], duration=0.5)
-                pyautogui.click(duration=0.3)
+        def settled():
+            filled = seen[0] = self.hotbar_detector.read_slots()
+            return filled is not None and (any(filled) or filled == self.inventory.hotbar)
 
-                if self.stop_requested: return self.cleanup()
+        if not settled() and wait:
+            self.wait_until(settled, wait)
+        if seen[0] is None:
+            return []
+        return self.inventory.observe_hotbar(seen[0])
+
+    @timed('sell_batch')
+    def _sell_from_hotbar(self, count, progress):
+        """Sell up to count items from the slots the model holds as filled; returns the sales vision confirmed.
+
+        Pipelined: instead of a fixed wait after each confirm click, the loop
+        watches frames until the sold slot reads empty with the sell screen
+        gone (see _await_sale). That frame is the
+        sale's checkpoint and also picks the next filled slot, whose number
+        key goes out at once, so the look for item N+1 costs nothing beyond
+        item N's server round trip. A sale not seen within the learned
+        'sell_confirm' wait ends the batch with a full checkpoint; if its
+        item is still there it is taken back from the model. progress(sold)
+        reports status.
+        """
+        inventory = self.inventory
+        slots = inventory.block_slots()
+        attempts = confirmed = 0
+        while slots and attempts < count and not self.stop_requested:
+            slot = slots[0]
+            # The number key is one input and needs no look; the wheel step after a sale is often lost.
+            self.inputs.press(str(slot + 1))
+            # With no other filled slot to show the overlay is gone, the last sale waits for the GUI to close.
+            self.sell_one_item(close_delay=0 if len(slots) > 1 else GUI_CLOSE_DELAY)
+            inventory.sold(slot)
+            attempts += 1
+            filled = self._await_sale(slot)
+            if filled is None:
+                # A lost confirm click or a lagging server; close the sell screen and let the checkpoint decide.
+                self._close_stray_screen()
+                if slot in self._check_hotbar():
+                    inventory.unsold()
+                    # Most often the confirm click went out before the sell screen was up.
+                    self.timing.missed('command', self.timing.wait('command'))
+                else:
+                    confirmed += 1
+                    progress(confirmed)
+                break
+            confirmed += 1
+            progress(confirmed)
+            inventory.observe_hotbar(filled)
+            slots = inventory.block_slots()
+        return confirmed
+
+    def _batch_sold(self, run, sold):
+        """False once MAX_FAILED_SELL_BATCHES batches in a row sold nothing; the model keeps the unsold items for a retry."""
+        if sold:
+            run.failed_batches = 0
+            return True
+        run.failed_batches += 1
+        self.bot_signals.update_status.emit("⚠ Sell retry", f"{run.remaining} left")
+        if run.failed_batches < self.MAX_FAILED_SELL_BATCHES:
+            return True
+        self.bot_signals.update_status.emit("❌ Sell failed", "stop")
+        return False
 
-                self.bot_signals.update_status.emit("Confirm", f"{remaining_empty} to fill")
-                pyautogui.click(960, 360, duration=0.4)
-                time.sleep(0.6)
+    def _state_sell_hotbar(self, run):
+        count = run.planned('hotbar', run.remaining)
+        sold = self._sell_from_hotbar(
+            count,
+            lambda n: self.bot_signals.update_status.emit("Sell hotbar", f"{run.remaining - n} left"),
+        )
+        if self.stop_requested: return None
+        if not self._batch_sold(run, sold):
+            return None
+        run.remaining -= sold
+        if run.remaining == 0:
+            self.bot_signals.update_status.emit("✅ Hotbar done", "done")
+            pause(2)
+            return None
+        return self._next_from_plan(run)
+
+    def _state_open_backpack(self, run):
+        self.bot_signals.update_status.emit("Open BP", f"{run.remaining} left")
+        self.inputs.press('e')
+        if not self.wait_for_gui('backpack', run.state.timeout):
+            raise StateFailed("backpack did not open")
+        self.wait_until(self._settled('backpack'), 0.3)
+        filled = len(self.detector.get_backpack_filled_clicks())
+        self.inventory.observe_backpack(filled)
+        if not filled:
+            self.timing.mark()
+            self.inputs.press('e')
+            self.wait_for_effect('gui_close', lambda: not self.gui_open('backpack'))
+            return 'plan'
+        return 'take_backpack'
+
+    def _state_take_backpack(self, run):
+        # Hotbar holds 9 slots: take min(empty AH slots left, 9). If empty > 9, multiple backpack passes happen.
+        target_take = min(run.remaining, self.inventory.hotbar_free, run.planned('backpack', run.remaining))
+        self.bot_signals.update_status.emit(f"Take ≤{target_take} BP", f"{run.remaining} left")
+
+        run.moved = self._collect_with_verification(
+            fetch_positions=self.detector.get_backpack_filled_clicks,
+            target_count=target_take,
+            status_prefix="Take",
+            progress_suffix=f"{run.remaining} left",
+            stop_callback=lambda: self.stop_requested,
+            region='backpack',
+        )
+        if self.stop_requested:
+            self.inputs.press('e')
+            return None
+        if run.moved == 0:
+            raise StateFailed("nothing moved out of the backpack")
+        self.inventory.moved_to_player(run.moved, from_backpack=True)
+
+        self.timing.mark()
+        self.inputs.press('e')
+        self.wait_for_effect('gui_close', lambda: not self.gui_open('backpack'), run.state.timeout)
+        self._check_hotbar(1.8)
+        return 'sell_backpack'
+
+    def _state_sell_backpack(self, run):
+        before = run.remaining
+        sold = self._sell_from_hotbar(
+            run.moved,
+            lambda n: self.bot_signals.update_status.emit(f"Sold {n}/{run.moved} BP", f"{before - n} left"),
+        )
+        if self.stop_requested: return None
+        if sold == 0 and not self.inventory.hotbar_count:
+            self.bot_signals.update_status.emit("❌ No hotbar block", "stop")
+            return None
+        if not self._batch_sold(run, sold):
+            return None
+        run.remaining -= sold
 
-                if self.stop_requested: return self.cleanup()
+        if run.remaining == 0:
+            self.bot_signals.update_status.emit("✅ BP done", "done")
+            pause(2)
+            return None
+        return 'plan'
+
+    def _order_clicks(self):
+        return self.detector.get_filled_clicks_in_region(
+            self.detector.order_x1,
+            self.detector.order_y1,
+            self.detector.order_x2,
+            self.detector.order_y2,
+            region='order',
+        )
 
-                order_clicks = self.detector.get_filled_clicks_in_region(
-                    self.detector.order_x1,
-                    self.detector.order_y1,
-                    self.detector.order_x2,
-                    self.detector.order_y2
-                )
-                # ≤9 empty: take only what’s needed. >9: max 9 per /order pass; outer loop runs again for the rest.
-                needed_this_batch = min(remaining_empty, MAX_ITEMS_PER_ORDER_SEQUENCE)
-                collect_count = min(needed_this_batch, len(order_clicks))
-                if collect_count == 0:
-                    self.bot_signals.update_status.emit("❌ No order items", "stop")
-                    return self.cleanup()
-
-                self.bot_signals.update_status.emit(f"Collect 0/{collect_count}", f"{remaining_empty} to fill")
-                moved = self._collect_with_verification(
-                    fetch_positions=lambda: self.detector.get_filled_clicks_in_region(
-                        self.detector.order_x1,
-                        self.detector.order_y1,
-                        self.detector.order_x2,
-                        self.detector.order_y2
-                    ),
-                    target_count=collect_count,
-                    status_prefix="Collect",
-                    progress_suffix=f"{remaining_empty} to fill",
-                    stop_callback=lambda: self.stop_requested
-                )
-                if self.stop_requested:
-                    return self.cleanup()
-                if moved == 0 and collect_count > 1:
-                    self.bot_signals.update_status.emit("❌ Collect failed", "stop")
-                    return self.cleanup()
+    def _state_open_order(self, run):
+        if run.remaining <= 0:
+            return 'complete'
+        self.bot_signals.update_status.emit("Open order", f"{run.remaining} to fill")
+        self.inputs.run([
+            InputStep('press', ('t',), 0.3),
+            InputStep('write', ('/order', 0.05)),
+            InputStep('press', ('enter',), self.timing.wait('command')),
+        ])
+
+        if self.stop_requested: return None
+
+        self.bot_signals.update_status.emit(f"Order #{run.order_option}", f"{run.remaining} to fill")
+        self.inputs.run([
+            InputStep('click', self.layout.click('menu_button'), self.timing.wait('server_gui')),
+            InputStep('click', self.layout.click(f'order_option_{run.order_option}'), self.timing.wait('server_gui')),
+        ])
+
+        if self.stop_requested: return None
+
+        self.bot_signals.update_status.emit("Confirm", f"{run.remaining} to fill")
+        self.timing.mark()
+        self.inputs.click(*self.layout.click('order_confirm'))
+        if self.wait_for_effect('server_gui', lambda: self.gui_open('order'), run.state.timeout):
+            self.wait_until(self._settled('order'), 0.3)
+        return 'collect'
+
+    def _state_collect(self, run):
+        # Take what the plan asked of this /order pass; anything past the free hotbar slots
+        # overflows into the backpack and is fetched by later backpack trips.
+        needed_this_batch = run.planned('order', min(run.remaining, MAX_ITEMS_PER_ORDER_SEQUENCE))
+        run.collect_count = min(needed_this_batch, len(self._order_clicks()))
+        if run.collect_count == 0:
+            self.bot_signals.update_status.emit("❌ No order items", "stop")
+            return None
 
-                if self.stop_requested: return self.cleanup()
+        self.bot_signals.update_status.emit(f"Collect 0/{run.collect_count}", f"{run.remaining} to fill")
+        run.moved = self._collect_with_verification(
+            fetch_positions=self._order_clicks,
+            target_count=run.collect_count,
+            status_prefix="Collect",
+            progress_suffix=f"{run.remaining} to fill",
+            stop_callback=lambda: self.stop_requested,
+            region='order',
+        )
+        if self.stop_requested:
+            return None
+        if run.moved == 0 and run.collect_count > 1:
+            self.bot_signals.update_status.emit("❌ Collect failed", "stop")
+            return None
 
-                pyautogui.press('e')
-                time.sleep(1)
+        hotbar_free = self.inventory.hotbar_free
+        overflow = self.inventory.moved_to_player(run.moved)
+        run.collect_count = min(run.collect_count, hotbar_free)
+        run.moved -= overflow
+
+        self.timing.mark()
+        self.inputs.press('e')
+        self.wait_for_effect('gui_close', lambda: not self.gui_open('order'), run.state.timeout)
+        self._check_hotbar(1.8)
+
+        # Sell by actual hotbar contents. Collection return value can undercount (vision),
+        # which previously stopped the loop early and left items on the hotbar before /order.
+        self.inputs.copy(run.sell_command)
+        return 'sell_order'
+
+    def _state_sell_order(self, run):
+        sold_count = 0
+        # Sell at most what this /order pass was meant to collect (not a blind 9).
+        max_sells_this_batch = max(run.collect_count, run.moved)
+        self.bot_signals.update_status.emit(
+            "Selling",
+            f"0/{max_sells_this_batch}",
+        )
 
-                # Sell by actual hotbar contents. Collection return value can undercount (vision),
-                # which previously stopped the loop early and left items on the hotbar before /order.
-                sell_command = f"/ah sell {self.current_sell_price}"
-                pyperclip.copy(sell_command)
-                sold_count = 0
-                # Sell at most what this /order pass was meant to collect (not a blind 9).
-                max_sells_this_batch = max(collect_count, moved)
+        while sold_count < max_sells_this_batch:
+            if self.stop_requested:
+                return None
 
+            if not self.inventory.hotbar_count:
+                # Do not treat "no block" as finished until we've sold at least one —
+                # the first pass often races the hotbar update after closing order UI.
+                if sold_count > 0:
+                    break
+                self.bot_signals.update_status.emit("⚠ No block → BP", "")
+                drained = self.drain_backpack()
+                if drained == 0:
+                    self.bot_signals.update_status.emit("❌ No blocks", "stop")
+                    return None
+                self.inventory.moved_to_player(drained, from_backpack=True)
+                self._check_hotbar(1.8)
+                if not self.inventory.hotbar_count:
+                    self.bot_signals.update_status.emit("❌ No block after BP", "stop")
+                    return None
+
+            asked = max_sells_this_batch - sold_count
+            sold = self._sell_from_hotbar(
+                asked,
+                lambda n: self.bot_signals.update_status.emit("Selling", f"{sold_count + n} sold"),
+            )
+            sold_count += sold
+            if sold < asked and not self.stop_requested:
                 self.bot_signals.update_status.emit(
-                    "Selling",
-                    f"0/{max_sells_this_batch}",
+                    "⚠ Sell retry",
+                    f"{sold_count} sold",
                 )
+                if sold == 0:
+                    # Leftovers stay in the model; 'plan' brings them back around.
+                    break
 
-                while sold_count < max_sells_this_batch:
-                    if self.stop_requested:
-                        return self.cleanup()
-
-                    self.bot_signals.update_status.emit(
-                        "Hotbar",
-                        f"{sold_count} sold ~{self.hotbar_detector.count_block_slots()}",
-                    )
-                    if not self.wait_for_hotbar_block():
-                        # Do not treat "no block" as finished until we've sold at least one —
-                        # the first pass often races the hotbar update after closing order UI.
-                        if sold_count > 0:
-                            break
-                        self.bot_signals.update_status.emit("⚠ No block → BP", "")
-                        drained = self.drain_backpack()
-                        if drained == 0:
-                            self.bot_signals.update_status.emit("❌ No blocks", "stop")
-                            return self.cleanup()
-                        if not self.wait_for_hotbar_block():
-                            self.bot_signals.update_status.emit("❌ No block after BP", "stop")
-                            return self.cleanup()
-
-                    before_blocks = self.hotbar_detector.count_block_slots()
-                    self.sell_one_item()
-                    time.sleep(0.2)
-                    after_blocks = self.hotbar_detector.count_block_slots()
-                    if after_blocks < before_blocks:
-                        sold_count += 1
-                    else:
-                        self.bot_signals.update_status.emit(
-                            "⚠ Sell retry",
-                            f"{sold_count} sold",
-                        )
-                        # Avoid counting a sale when command/confirmation did not consume item.
-                        continue
-                    self.bot_signals.update_status.emit(
-                        "Selling",
-                        f"{sold_count} sold",
-                    )
-
-                if sold_count == 0:
-                    self.bot_signals.update_status.emit(
-                        "❌ Nothing to sell",
-                        "stop",
-                    )
-                    return self.cleanup()
-
-                remaining_empty -= sold_count
-
-            self.bot_signals.update_status.emit("✅ Complete", "done")
-            time.sleep(2)
-            self.bot_signals.update_status.emit(" ", "")
-            self.cleanup()
-            return
+        if sold_count == 0 and not self.inventory.hotbar_count and not self.inventory.backpack:
+            self.bot_signals.update_status.emit(
+                "❌ Nothing to sell",
+                "stop",
+            )
+            return None
+        if not self._batch_sold(run, sold_count):
+            return None
 
-        except Exception as e:
-            self.bot_signals.update_status.emit(f"❌ {str(e)}", "stop")
-            self.cleanup()
+        run.remaining -= sold_count
+        return 'plan'
+
+    def _state_complete(self, run):
+        self.bot_signals.update_status.emit("✅ Complete", "done")
+        pause(2)
+        self.bot_signals.update_status.emit(" ", "")
+        return None
 
     def cleanup(self):
+        STAGE_TIMER.stage(None)
         self.running = False
         self.stop_requested = False
         if not self.status_label.text().startswith("✅"):
@@ -1761,12 +4769,13 @@ class MainWindow(QMainWindow):
         return img
 
     def hotbar_detection_loop(self):
+        gate = FrameChangeGate()
         while self.hotbar_running:
             try:
                 img = self.hotbar_detector.capture_hotbar()
-                if img is not None:
-                    slot_idx = self.hotbar_detector.find_selected_slot(img)
-                    all_slot_results = self.hotbar_detector.analyze_all_slots(img)
+                if img is not None and gate.changed(img):
+                    slot_idx, variances = self.hotbar_detector.analyze_hotbar(img)
+                    all_slot_results = self.hotbar_detector.slot_results(variances)
                     max_variance = max((v for _, v in all_slot_results), default=0)
                     self.hb_signals.update_labels.emit(slot_idx, all_slot_results)
 
@@ -1777,12 +4786,13 @@ class MainWindow(QMainWindow):
                         self.hb_signals.update_display.emit(img_display)
                     else:
                         self.hb_signals.show_waiting.emit()
-                time.sleep(0.05)
+                pause(0.05)
             except Exception as e:
                 print(f"hotbar_detection_loop error: {e}")
-                time.sleep(0.1)
+                pause(0.1)
 
     @Slot(int, list)
+    @timed('ui.hotbar_labels')
     def hb_update_labels(self, slot_idx, all_slot_results):
         if slot_idx != -1:
             _, variance = all_slot_results[slot_idx]
@@ -1794,6 +4804,7 @@ class MainWindow(QMainWindow):
         self._set_stat_value(self.hb_var_val, var)
 
     @Slot(np.ndarray)
+    @timed('ui.hotbar_preview')
     def hb_update_display(self, img):
         label_width = self.HOTBAR_PREVIEW_W
         src_h, src_w = img.shape[:2]
@@ -1820,54 +4831,42 @@ class MainWindow(QMainWindow):
 
     # --- Chest Detector Logic ---
     def book_detection_loop(self):
+        gate = FrameChangeGate()
         while self._book_loop_running:
             try:
-                book_detected = self.detector.detect_book_on_screen()
-                hijau_detected = self.detector.detect_hijau_on_screen()
-                order_detected = self.detector.detect_order_on_screen()
-
-                if (book_detected or hijau_detected or order_detected) and not self.chest_monitoring:
-                    # Prioritize ORDER over BACKPACK when both templates match.
-                    if order_detected:
-                        self.chest_active_region = 'order'
-                        self.ch_signals.mode_changed.emit("Order", _CLR_RED)
-                    elif hijau_detected:
-                        self.chest_active_region = 'backpack'
-                        self.ch_signals.mode_changed.emit("Backpack", _CLR_RED)
-                    else:
-                        self.chest_active_region = 'chest'
-                        self.ch_signals.mode_changed.emit("Auction", _CLR_RED)
-                    
+                img = self.detector.capture_region(*self.detector.gui_bbox)
+                if img is None or not gate.changed(img):
+                    pause(0.03)
+                    continue
+                # The gated grab, all templates; ScreenState applies ORDER > BACKPACK > AUCTION priority.
+                gui = self.detector.classify_screen(img=img).gui
+
+                if gui is not None and not self.chest_monitoring:
+                    self.chest_active_region = gui
+                    self.ch_signals.mode_changed.emit(self.CHEST_MODE_LABELS[gui], _CLR_RED)
                     self.ch_signals.status_changed.emit("#00ff00")
                     self.start_chest_monitoring()
 
-                elif (book_detected or hijau_detected or order_detected) and self.chest_monitoring:
-                    # Keep ORDER priority consistent during active monitoring.
-                    if order_detected and self.chest_active_region != 'order':
-                        self.chest_active_region = 'order'
-                        self.ch_signals.mode_changed.emit("Order", _CLR_RED)
-                    elif hijau_detected and self.chest_active_region != 'backpack':
-                        self.chest_active_region = 'backpack'
-                        self.ch_signals.mode_changed.emit("Backpack", _CLR_RED)
-                    elif book_detected and not hijau_detected and not order_detected and self.chest_active_region != 'chest':
-                        self.chest_active_region = 'chest'
-                        self.ch_signals.mode_changed.emit("Auction", _CLR_RED)
-
-                elif not book_detected and not hijau_detected and not order_detected and self.chest_monitoring:
+                elif gui is not None and self.chest_monitoring:
+                    if self.chest_active_region != gui:
+                        self.chest_active_region = gui
+                        self.ch_signals.mode_changed.emit(self.CHEST_MODE_LABELS[gui], _CLR_RED)
+
+                elif gui is None and self.chest_monitoring:
                     self.stop_chest_monitoring()
                     self.ch_signals.status_changed.emit("#ff3333")
                     self.ch_signals.mode_changed.emit("N/A", _CLR_TEXT)
 
                 # Tight polling so the detector view disappears almost instantly.
-                time.sleep(0.03)
+                pause(0.03)
             except Exception as e:
                 print(f"book_detection_loop error: {e}")
-                time.sleep(0.1)
+                pause(0.1)
 
     def start_chest_monitoring(self):
         if not self.chest_monitoring:
             self.chest_monitoring = True
-            self.chest_monitor_thread = threading.Thread(target=self.chest_monitoring_loop, daemon=True)
+            self.chest_monitor_thread = threading.Thread(target=self.chest_monitoring_loop, name="chest-monitor", daemon=True)
             self.chest_monitor_thread.start()
 
     def stop_chest_monitoring(self):
@@ -1875,24 +4874,21 @@ class MainWindow(QMainWindow):
         self.ch_signals.reset_display.emit()
 
     def chest_monitoring_loop(self):
+        gate = FrameChangeGate()
         while self.chest_monitoring:
             try:
-                if self.chest_active_region == 'backpack':
-                    img = self.detector.capture_region(self.detector.bp_x1, self.detector.bp_y1, self.detector.bp_x2, self.detector.bp_y2)
-                elif self.chest_active_region == 'order':
-                    img = self.detector.capture_region(self.detector.order_x1, self.detector.order_y1, self.detector.order_x2, self.detector.order_y2)
-                else:
-                    img = self.detector.capture_region(self.detector.x1, self.detector.y1, self.detector.x2, self.detector.y2)
-                
-                if img is not None:
-                    empty_count, filled_count, analyzed = self.detector.analyze_slots(img)
+                region = self.chest_active_region
+                img = self.detector.capture_region(*self.detector.region_box(region))
+
+                if img is not None and gate.changed(img, key=region):
+                    empty_count, filled_count, analyzed = self.detector.analyze_slots(img, region)
                     output = self.detector.draw_slot_overlay(img, analyzed)
                     self.ch_signals.update_display.emit(empty_count, filled_count, output)
                 # Keep refresh quick for lower visual latency.
-                time.sleep(0.05)
+                pause(0.05)
             except Exception as e:
                 print(f"chest_monitoring_loop error: {e}")
-                time.sleep(0.1)
+                pause(0.1)
 
     @Slot(str, str)
     def ch_mode_changed(self, text, _color):
@@ -1906,6 +4902,7 @@ class MainWindow(QMainWindow):
         self.ch_status_val.setStyleSheet(self._status_dot_active_stylesheet(color))
 
     @Slot(int, int, np.ndarray)
+    @timed('ui.chest_preview')
     def ch_update_display(self, empty, filled, img):
         if not self._accept_chest_preview_updates:
             return
@@ -1944,16 +4941,203 @@ class MainWindow(QMainWindow):
         if app is not None:
             QTimer.singleShot(0, app.quit)
 
+def replay_session(path, mode='sequence'):
+    """Re-run run_automation headlessly against a recorded session.
+
+    Returns a dict with the replayed statuses and inputs, the recorded ones,
+    and the read index where the replay diverged (None if it never did).
+    """
+    global USER_CACHES
+    USER_CACHES = False
+    session = RecordedSession(path)
+    app = QApplication.instance() or QApplication(sys.argv)
+    inputs = FakeInput()
+    capture = SessionReplayCapture(session, mode)
+    window = MainWindow(capture=capture, inputs=inputs, headless=True)
+    window.apply_layout(session.layout())
+    statuses = []
+    window.bot_signals.update_status.connect(lambda message, progress: statuses.append((message, progress)))
+    window.current_sell_price = session.meta.get('sell_price', window._sell_price_for_command())
+    window.current_order_option = session.meta.get('order_option', window.order_input.value())
+    window.running = True
+    window.stop_requested = False
+    started = time.monotonic()
+    window.run_automation()
+    app.processEvents()
+    elapsed = time.monotonic() - started
+    replayed = [(a, list(args), dict(kwargs)) for _, a, args, kwargs in inputs.actions]
+    recorded = [(e['action'], e['args'], e['kwargs']) for e in session.inputs]
+    first_diff = next(
+        (i for i, (a, b) in enumerate(zip(replayed, recorded)) if a != b),
+        None if len(replayed) == len(recorded) else min(len(replayed), len(recorded)),
+    )
+    return {
+        'elapsed': elapsed,
+        'statuses': statuses,
+        'inputs': replayed,
+        'recorded_inputs': recorded,
+        'first_input_diff': first_diff,
+        'diverged': capture.diverged,
+    }
+
+
+def replay_frames(path):
+    """Run the detectors over every frame of a ReplayFrameSource recording (PNG directory or .npz).
+
+    Returns one dict per frame: its recorded time 't', the open container
+    'gui' (or None), the 'selected' hotbar slot, the 'hotbar' read and, with
+    a container open, its (empty, filled) 'slots' counts.
+    """
+    global USER_CACHES
+    USER_CACHES = False
+    source = ReplayFrameSource(path)
+    layout = LayoutProfile()
+    capture = ScreenCapture(bbox=layout.capture_bbox(), source=source, threaded=False)
+    hotbar = HotbarDetector(capture)
+    detector = InventoryDetector(capture)
+    hotbar.apply_layout(layout)
+    detector.apply_layout(layout)
+    results = []
+    for _ in range(len(source)):
+        capture.advance()
+        gui = detector.classify_screen().gui
+        strip = hotbar.capture_hotbar()
+        selected, variances = hotbar.analyze_hotbar(strip) if strip is not None else (-1, np.zeros(9))
+        slots = None
+        if gui is not None:
+            slots = detector.analyze_slots(detector.capture_region(*detector.region_box(gui)), gui)[:2]
+        results.append({
+            't': source.timestamp,
+            'gui': gui,
+            'selected': int(selected),
+            'hotbar': (variances > hotbar.block_variance).tolist(),
+            'slots': slots,
+        })
+    return results
+
+
+def simulate_run(game=None, sell_price="5k", order_option=1, **options):
+    """Run run_automation headlessly against a GameSimulator and report its stats.
+
+    options go to GameSimulator when no game is given. The report holds
+    listed items per minute, inputs, wasted clicks, dropped inputs, failed
+    sells and the number of retry statuses the bot emitted.
+    """
+    global USER_CACHES
+    USER_CACHES = False
+    game = game or GameSimulator(**options)
+    app = QApplication.instance() or QApplication(sys.argv)
+    window = MainWindow(capture=SimulatedCapture(game), inputs=game, headless=True)
+    window.apply_layout(game.layout)
+    statuses = []
+    window.bot_signals.update_status.connect(lambda message, progress: statuses.append((message, progress)))
+    window.current_sell_price = sell_price
+    window.current_order_option = order_option
+    window.running = True
+    window.stop_requested = False
+    started = time.monotonic()
+    window.run_automation()
+    app.processEvents()
+    report = game.report(time.monotonic() - started)
+    report['retries'] = sum(1 for message, _ in statuses if message.startswith("⚠"))
+    report['final_status'] = next((message for message, _ in reversed(statuses) if message.strip()), "")
+    return report
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Auto")
+    parser.add_argument('--input', choices=sorted(INPUT_BACKENDS), default='pyautogui',
+                        help="input backend: pyautogui (default), direct (Windows user32), xtest (X11 / Xvfb), fake (send nothing)")
+    parser.add_argument('--teleport-clicks', action='store_true', help="shift-click slots without hovering them first")
+    parser.add_argument('--transfer', choices=('auto', 'click', 'drag', 'double'), default='auto',
+                        help="how items leave a container: auto picks the cheapest of shift+double-click, row shift-drag and per-slot shift-click")
+    parser.add_argument('--record', metavar='DIR', help="save every automation run as a session zip in DIR")
+    parser.add_argument('--replay', metavar='SESSION', help="re-run automation headlessly against a recorded session")
+    parser.add_argument('--timeline', action='store_true', help="replay by elapsed time instead of read order")
+    parser.add_argument('--frames', metavar='PATH', help="run the detectors over recorded frames (PNG directory or .npz) and print each frame's reads")
+    parser.add_argument('--simulate', action='store_true', help="run automation headlessly against the built-in game simulator")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="share of simulated inputs the game ignores")
+    parser.add_argument('--timings', metavar='FILE', help="time automation stages and detectors; summary shown in the overlay and written to FILE after each run")
+    parser.add_argument('--trace', metavar='FILE', help="write a chrome://tracing / Perfetto trace of every thread to FILE (implies timing)")
+    parser.add_argument('--bench', action='store_true', help="time the detectors on golden frames; fails on any misread")
+    parser.add_argument('--bench-frames', metavar='DIR', help="labelled real captures (DIR/frames.json) --bench checks accuracy on")
+    parser.add_argument('--bench-out', metavar='FILE', help="save --bench results as JSON")
+    parser.add_argument('--bench-baseline', metavar='FILE', help="compare --bench against results saved earlier")
+    args, qt_args = parser.parse_known_args()
+
     os.environ["QT_LOGGING_RULES"] = "qt.qpa.window=false"
-    pyautogui.PAUSE = 0.1
     pyautogui.FAILSAFE = True
-
-    app = QApplication(sys.argv)
+    # pyautogui sleeps PAUSE after every call; PyAutoGuiInput paces inputs with InputStep.after instead.
+    pyautogui.PAUSE = 0
+
+    STAGE_TIMER.enabled = bool(args.timings or args.trace)
+    if args.trace:
+        STAGE_TIMER.trace = TraceLog()
+
+    if args.bench:
+        results = DetectorBenchmark(frames_dir=args.bench_frames).run()
+        baseline = None
+        if args.bench_baseline:
+            with open(args.bench_baseline, 'r', encoding='utf-8') as f:
+                baseline = json.load(f)
+        print(DetectorBenchmark.format(results, baseline))
+        if not args.bench_frames:
+            print("No --bench-frames: errors are only checked on simulator renders.")
+        if args.bench_out:
+            with open(args.bench_out, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=1)
+        sys.exit(1 if any(r['errors'] for r in results.values()) else 0)
+
+    if args.simulate:
+        report = simulate_run(drop_rate=args.drop_rate)
+        print(json.dumps(report, indent=1))
+        if args.timings:
+            STAGE_TIMER.dump(args.timings)
+        if args.trace:
+            STAGE_TIMER.trace.save(args.trace)
+        sys.exit(0)
+
+    if args.frames:
+        for read in replay_frames(args.frames):
+            hotbar = ''.join('#' if has else '.' for has in read['hotbar'])
+            slots = '' if read['slots'] is None else f" {read['slots'][1]} filled / {read['slots'][0]} empty"
+            print(f"{read['t']:8.3f}s  {read['gui'] or 'world':<8} hotbar {hotbar} sel {read['selected'] + 1}{slots}")
+        if args.timings:
+            STAGE_TIMER.dump(args.timings)
+        if args.trace:
+            STAGE_TIMER.trace.save(args.trace)
+        sys.exit(0)
+
+    if args.replay:
+        result = replay_session(args.replay, 'timeline' if args.timeline else 'sequence')
+        if args.timings:
+            STAGE_TIMER.dump(args.timings)
+        if args.trace:
+            STAGE_TIMER.trace.save(args.trace)
+        print(f"Replayed in {result['elapsed']:.2f}s: {len(result['inputs'])} inputs "
+              f"({len(result['recorded_inputs'])} recorded), {len(result['statuses'])} status updates")
+        if result['diverged'] is not None:
+            print(f"Screen reads diverged at read {result['diverged']}")
+        if result['first_input_diff'] is not None:
+            print(f"Inputs differ from the recording at action {result['first_input_diff']}")
+        sys.exit(0 if result['diverged'] is None and result['first_input_diff'] is None else 1)
+
+    app = QApplication(sys.argv[:1] + qt_args)
     app.setQuitOnLastWindowClosed(True)
     app.setStyle("Fusion")
     app.setFont(load_app_font(ui_px(10)))
-    window = MainWindow()
+    try:
+        inputs = INPUT_BACKENDS[args.input]()
+    except RuntimeError as e:
+        print(f"Input backend '{args.input}' unavailable: {e}")
+        sys.exit(1)
+    window = MainWindow(inputs=inputs)
+    window.transfer_teleport = args.teleport_clicks
+    if args.transfer != 'auto':
+        window.transfer_strategies = (args.transfer, 'click')
+    window.record_dir = args.record
+    window.timings_path = args.timings
+    window.trace_path = args.trace
     window.show()
     sys.exit(app.exec())
 